@@ -1,9 +1,148 @@
+from datetime import timedelta
+
+from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import F, Q
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+
+from loginurl.audit import digest
+from loginurl.export import iter_export
+from loginurl.models import Key, KeyEvent
+from loginurl.storage import estimate_rows
+
+def estimate_count(queryset):
+    """
+    Return the number of rows in the table of the queryset as estimated by
+    the database statistics, or ``None`` if no estimate is available.
+    """
+    return estimate_rows(connections[queryset.db],
+                         queryset.model._meta.db_table)
+
+class LargeTablePaginator(Paginator):
+    """
+    A paginator that does not count all rows of large tables.
+
+    Unfiltered lists use the row count estimated by the database when it is
+    above ``settings.LOGINURL_ADMIN_COUNT_LIMIT`` (10000 by default). Filtered
+    lists are counted up to that limit only.
+    """
+    def _get_count(self):
+        if self._count is None:
+            limit = getattr(settings, 'LOGINURL_ADMIN_COUNT_LIMIT', 10000)
+            queryset = self.object_list
+
+            count = None
+            if not queryset.query.where:
+                count = estimate_count(queryset)
+                if count is not None and count < limit:
+                    count = None
+            if count is None:
+                # COUNT(*) ignores the slice on some Django versions, so the
+                # primary keys are fetched instead.
+                count = len(queryset.values_list('pk', flat=True)[:limit])
+
+            self._count = count
+        return self._count
+    count = property(_get_count)
+
+class LargeTableChangeList(ChangeList):
+    """
+    A change list that counts all rows of the table like
+    ``LargeTablePaginator`` when the list is filtered, instead of with a
+    ``COUNT(*)``.
+    """
+    def get_results(self, request):
+        root = self.root_queryset
+        counted = root._clone()
+        counted.count = lambda: LargeTablePaginator(root, 1).count
+        self.root_queryset = counted
+
+        super(LargeTableChangeList, self).get_results(request)
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """
+    An admin that does not count all rows of large tables.
+    """
+    paginator = LargeTablePaginator
 
-from loginurl.models import Key
+    def get_changelist(self, request, **kwargs):
+        return LargeTableChangeList
 
-class KeyAdmin(admin.ModelAdmin):
+class ValidityListFilter(admin.SimpleListFilter):
+    title = 'validity'
+    parameter_name = 'validity'
+
+    def lookups(self, request, model_admin):
+        return (
+            ('valid', 'Valid'),
+            ('used', 'Used up'),
+            ('expired', 'Expired'),
+        )
+
+    def queryset(self, request, queryset):
+        now = timezone.now()
+        if self.value() == 'valid':
+            return queryset.filter(Q(usage_left__isnull=True) |
+                                   Q(usage_left__gt=0),
+                                   Q(expires__isnull=True) |
+                                   Q(expires__gte=now))
+        if self.value() == 'used':
+            return queryset.filter(usage_left__lte=0)
+        if self.value() == 'expired':
+            return queryset.filter(expires__lt=now)
+
+class KeyAdmin(LargeTableAdmin):
     list_display = ('user', 'key', 'created', 'usage_left', 'expires')
+    list_select_related = ('user',)
+    list_filter = (ValidityListFilter,)
+    date_hierarchy = 'created'
+    raw_id_fields = ('user',)
+    actions = ['expire', 'extend', 'revoke', 'export_urls']
+
+    def expire(self, request, queryset):
+        count = queryset.update(expires=timezone.now())
+        self.message_user(request, '{} keys expired.'.format(count))
+    expire.short_description = 'Expire selected keys now'
+
+    def extend(self, request, queryset):
+        count = queryset.exclude(expires=None) \
+                        .update(expires=F('expires') + timedelta(days=7))
+        self.message_user(request, '{} keys extended.'.format(count))
+    extend.short_description = 'Extend the expiry of selected keys by a week'
+
+    def revoke(self, request, queryset):
+        count = queryset.update(usage_left=0)
+        self.message_user(request, '{} keys revoked.'.format(count))
+    revoke.short_description = 'Revoke selected keys'
+
+    def export_urls(self, request, queryset):
+        base_url = request.build_absolute_uri('/')
+        response = StreamingHttpResponse(iter_export(queryset,
+                                                     base_url=base_url),
+                                         content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename=loginurls.csv'
+        return response
+    export_urls.short_description = 'Export login URLs of selected keys as CSV'
 
 admin.site.register(Key, KeyAdmin)
 
+class KeyEventAdmin(LargeTableAdmin):
+    list_display = ('created', 'action', 'key', 'user', 'ip', 'detail')
+    list_filter = ('action',)
+    date_hierarchy = 'created'
+    raw_id_fields = ('user',)
+    search_fields = ('=key',)
+
+    def get_search_results(self, request, queryset, search_term):
+        # Events store the digest of the keys.
+        search_term = search_term.strip()
+        if search_term:
+            search_term = digest(search_term)
+        return super(KeyEventAdmin, self).get_search_results(
+            request, queryset, search_term)
+
+admin.site.register(KeyEvent, KeyEventAdmin)
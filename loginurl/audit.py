@@ -0,0 +1,138 @@
+"""
+Audit log of key usage.
+
+When ``settings.LOGINURL_AUDIT`` is ``True``, the keys issued, the successful
+and failed log ins and the clean ups are recorded as ``KeyEvent`` entries.
+Events are kept in memory and inserted with ``bulk_create`` by a background
+thread every ``settings.LOGINURL_AUDIT_FLUSH_INTERVAL`` seconds (5 by
+default), or as soon as ``settings.LOGINURL_AUDIT_BATCH_SIZE`` events (100 by
+default) are waiting, so the requests recording them never wait for the
+database. With an interval of 0, the events are inserted by the request
+reaching the batch size instead.
+
+At most ``settings.LOGINURL_AUDIT_MAX_BUFFER`` events (10000 by default) are
+kept in memory; older ones are dropped if the database cannot keep up, and
+counted in ``dropped``. Events still in memory are inserted when the process
+exits. Errors of the background thread are logged to the ``loginurl.audit``
+logger.
+
+Keys are recorded as their digest, see ``digest``, so the log does not hold
+keys that can still be used.
+"""
+import atexit
+import logging
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+from django.utils.crypto import salted_hmac
+
+from loginurl.models import KeyEvent
+
+ISSUED = KeyEvent.ISSUED
+SUCCESS = KeyEvent.SUCCESS
+FAILURE = KeyEvent.FAILURE
+CLEANUP = KeyEvent.CLEANUP
+
+logger = logging.getLogger(__name__)
+
+dropped = 0
+
+_buffer = deque()
+_lock = threading.Lock()
+_wake = threading.Event()
+_flusher = None
+
+def is_enabled():
+    return getattr(settings, 'LOGINURL_AUDIT', False)
+
+def digest(key):
+    """
+    Return the digest of a key recorded in ``KeyEvent.key``, an HMAC keyed
+    with ``settings.SECRET_KEY``.
+    """
+    return salted_hmac('loginurl.audit', key).hexdigest()
+
+def record(action, key='', user=None, request=None, detail=''):
+    """
+    Record an event. Does nothing unless the audit log is enabled.
+    """
+    global dropped
+
+    if not is_enabled():
+        return
+
+    ip = None
+    if request is not None:
+        ip = request.META.get('REMOTE_ADDR') or None
+    if key:
+        key = digest(key)
+    event = KeyEvent(action=action, key=key, ip=ip, detail=detail,
+                     user_id=user.pk if user is not None else None,
+                     created=timezone.now())
+
+    size = getattr(settings, 'LOGINURL_AUDIT_BATCH_SIZE', 100)
+    limit = getattr(settings, 'LOGINURL_AUDIT_MAX_BUFFER', 10000)
+    with _lock:
+        _buffer.append(event)
+        while len(_buffer) > limit:
+            _buffer.popleft()
+            dropped += 1
+        full = len(_buffer) >= size
+
+    if _start_flusher():
+        if full:
+            _wake.set()
+    elif full:
+        flush()
+
+def flush(close=False):
+    """
+    Insert the events waiting in memory. Returns the number of events
+    inserted.
+    """
+    with _lock:
+        events = list(_buffer)
+        _buffer.clear()
+
+    try:
+        if events:
+            KeyEvent.objects.bulk_create(events)
+    finally:
+        if close:
+            connection.close()
+
+    return len(events)
+
+def _run(interval):
+    while True:
+        _wake.wait(interval)
+        _wake.clear()
+        try:
+            flush(close=True)
+        except Exception:
+            logger.exception('Error while inserting the audit events')
+
+def _start_flusher():
+    """
+    Start the thread inserting the events, if it is enabled and not running
+    yet. Returns ``True`` if the thread is running.
+    """
+    global _flusher
+
+    if _flusher is None:
+        with _lock:
+            if _flusher is None:
+                interval = getattr(settings, 'LOGINURL_AUDIT_FLUSH_INTERVAL',
+                                   5)
+                if interval:
+                    _flusher = threading.Thread(target=_run, args=(interval,))
+                    _flusher.daemon = True
+                    _flusher.start()
+                else:
+                    _flusher = False
+                atexit.register(flush)
+
+    return bool(_flusher)
@@ -1,33 +1,133 @@
+import copy
+
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.db import router
+from django.db.models.signals import post_save, post_delete
+
+from loginurl import utils, throttling, metrics, bloom
+from loginurl.cache import LRUCache
+from loginurl.storage import get_storage
+
+_user_cache = None
+
+def get_user_cache():
+    """
+    Return the cache used by ``LoginUrlBackend.get_user``.
+
+    The cache is enabled by setting ``settings.LOGINURL_USER_CACHE_SIZE`` to
+    the maximum number of users kept in each process. The users expire after
+    ``settings.LOGINURL_USER_CACHE_TTL`` seconds (60 by default). Returns
+    ``None`` if the cache is disabled.
+    """
+    global _user_cache
+
+    size = getattr(settings, 'LOGINURL_USER_CACHE_SIZE', 0)
+    if not size:
+        return None
+
+    ttl = getattr(settings, 'LOGINURL_USER_CACHE_TTL', 60)
+    if _user_cache is None or _user_cache.size != size or \
+       _user_cache.ttl != ttl:
+        _user_cache = LRUCache(size, ttl)
+
+    return _user_cache
+
+def invalidate_user(sender, instance, **kwargs):
+    """
+    Remove a saved or deleted user from the ``get_user`` cache.
+    """
+    if _user_cache is not None:
+        _user_cache.delete(str(instance.pk))
 
-from loginurl.models import Key
+post_save.connect(invalidate_user, sender=User,
+                  dispatch_uid='loginurl.backends.invalidate_user')
+post_delete.connect(invalidate_user, sender=User,
+                    dispatch_uid='loginurl.backends.invalidate_user')
 
 class LoginUrlBackend:
     """
     Authentication backend that checks the given ``key`` to a record in the
-    ``Key`` model. If the record is found, then ``is_valid()`` method is called
-    to check if the key is still valid.
+    key storage, which is the ``Key`` model by default. If the record is found
+    and still valid, one of its usages is spent and the key record is attached
+    to the returned user as ``loginurl_key``.
+
+    Signed keys created by ``utils.create_signed`` are validated without
+    looking up the ``Key`` model. Malformed keys, keys recently found to be
+    invalid and keys missing from the filter of ``loginurl.bloom`` are
+    rejected without looking them up.
     """
     supports_object_permissions = False
     supports_anonymous_user = False
 
     def authenticate(self, key):
         """
-        Check if the key is valid.
+        Check if the key is valid and consume it.
         """
-        data = Key.objects.filter(key=key)
-        if len(data) == 0:
+        if utils.is_signed(key):
+            data = utils.consume_signed(key)
+        elif not utils.is_valid_format(key) or \
+             throttling.is_known_invalid(key) or \
+             not bloom.might_exist(key):
+            metrics.report(key, metrics.INVALID)
             return None
+        else:
+            data = get_storage().consume(key)
+
+        if data is not None:
+            try:
+                user = data.user
+            except User.DoesNotExist:
+                # Keys that are not stored in the Key model are not deleted
+                # with their user.
+                metrics.report(key, metrics.INVALID)
+                data = None
 
-        data = data[0]
-        if not data.is_valid():
+        if data is None:
+            throttling.remember_invalid(key)
             return None
 
-        return data.user
+        metrics.report(key, metrics.SUCCESS)
+        user.loginurl_key = data
+        return user
 
     def get_user(self, user_id):
+        """
+        Return the user with the given id.
+
+        If the ``get_user`` cache is enabled, a copy of the cached user is
+        returned when possible. The cache is only invalidated in the process
+        saving or deleting a user, so other processes may see a stale user
+        until it expires.
+
+        The user is read from ``settings.LOGINURL_READ_DATABASE`` if it is set,
+        falling back to the primary database if the user is not found there.
+        """
+        cache = get_user_cache()
+        if cache is not None:
+            user = cache.get(str(user_id))
+            if user is not None:
+                return copy.copy(user)
+
+        user = self._get_user(user_id)
+        if user is None:
+            return None
+
+        if cache is not None:
+            cache.set(str(user_id), copy.copy(user))
+        return user
+
+    def _get_user(self, user_id):
+        read = getattr(settings, 'LOGINURL_READ_DATABASE', None)
+        if read is not None:
+            try:
+                user = User.objects.using(read).get(pk=user_id)
+                metrics.count_route('replica')
+                return user
+            except User.DoesNotExist:
+                metrics.count_route('fallback')
+
         try:
-            return User.objects.get(pk=user_id)
+            return User.objects.using(router.db_for_write(User)).get(pk=user_id)
         except User.DoesNotExist:
             return None
-        
@@ -0,0 +1,207 @@
+"""
+In process filter of existing keys.
+
+When ``settings.LOGINURL_BLOOM_CAPACITY`` is set, each process keeps a Bloom
+filter of the keys in the key storage, so that keys that do not exist, e.g.
+mistyped or guessed ones, are rejected without a query. The filter is built
+from the storage by a background thread the first time it is needed, and
+rebuilt every ``settings.LOGINURL_BLOOM_REBUILD_INTERVAL`` seconds (one hour
+by default) to forget removed keys. Until it is built, all keys are looked up.
+
+Keys created by the process are added to the filter as they are created. Keys
+created by other processes are added by looking up the keys created since the
+last look up, when a key is not found in the filter. This is done at most
+every ``settings.LOGINURL_BLOOM_SYNC_INTERVAL`` seconds (1 by default), so a
+key used within that time after being created by another process may be
+rejected. Keys are looked up by creation time rather than primary key, since
+keys are not committed in the order of their primary keys. The look up goes
+back ``settings.LOGINURL_BLOOM_SYNC_MARGIN`` seconds (60 by default) before
+the last one, so keys committed up to that long after being created are still
+found.
+
+Only storages implementing ``iter_keys``, such as ``ModelStorage`` and
+``CompactModelStorage``, can be filtered.
+"""
+import math
+import time
+import struct
+import hashlib
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.db.models.signals import post_save
+from django.utils import timezone
+
+from loginurl.models import Key, CompactKey
+
+_filter = None
+_building = False
+_lock = threading.Lock()
+
+class BloomFilter(object):
+    """
+    A Bloom filter sized for ``capacity`` items with a false positive rate of
+    ``error_rate``.
+    """
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bits = max(int(math.ceil(-capacity * math.log(error_rate) /
+                                      math.log(2) ** 2)), 8)
+        self.hashes = max(int(round(self.bits / float(capacity) *
+                                    math.log(2))), 1)
+        self.count = 0
+        self._data = bytearray((self.bits + 7) // 8)
+        self._lock = threading.Lock()
+
+    def _indexes(self, item):
+        digest = hashlib.md5(item.encode('utf-8')).digest()
+        h1, h2 = struct.unpack('<QQ', digest)
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, item):
+        indexes = self._indexes(item)
+        with self._lock:
+            for index in indexes:
+                self._data[index >> 3] |= 1 << (index & 7)
+            self.count += 1
+
+    def __contains__(self, item):
+        data = self._data
+        return all(data[index >> 3] & (1 << (index & 7))
+                   for index in self._indexes(item))
+
+    def estimated_error_rate(self):
+        """
+        Return the false positive rate expected with the number of items
+        added so far.
+        """
+        return (1 - math.exp(-self.hashes * self.count /
+                             float(self.bits))) ** self.hashes
+
+    def stats(self):
+        return {
+            'capacity': self.capacity,
+            'count': self.count,
+            'bytes': len(self._data),
+            'hashes': self.hashes,
+            'error_rate': self.error_rate,
+            'estimated_error_rate': self.estimated_error_rate(),
+        }
+
+def _get_storage():
+    from loginurl.storage import get_storage
+
+    return get_storage()
+
+def is_enabled():
+    if not getattr(settings, 'LOGINURL_BLOOM_CAPACITY', 0):
+        return False
+    return _get_storage().iter_keys is not None
+
+def rebuild(close=False):
+    """
+    Build a new filter from all the keys of the storage and use it. Returns
+    the new filter.
+    """
+    global _filter, _building
+
+    try:
+        capacity = getattr(settings, 'LOGINURL_BLOOM_CAPACITY', 0)
+        error_rate = getattr(settings, 'LOGINURL_BLOOM_ERROR_RATE', 0.01)
+        data = BloomFilter(capacity, error_rate)
+        data.built = data.synced = time.time()
+        data.since = timezone.now()
+        for key in _get_storage().iter_keys():
+            data.add(key)
+
+        _filter = data
+        return data
+    finally:
+        _building = False
+        if close:
+            connection.close()
+
+def get_filter():
+    """
+    Return the filter of this process, or ``None`` if it is disabled or not
+    built yet. A background thread is started to build the filter if it does
+    not exist or is too old.
+    """
+    global _building
+
+    if not is_enabled():
+        return None
+
+    interval = getattr(settings, 'LOGINURL_BLOOM_REBUILD_INTERVAL', 3600)
+    data = _filter
+    if data is None or data.built + interval < time.time():
+        with _lock:
+            start = not _building
+            _building = True
+        if start:
+            thread = threading.Thread(target=rebuild, args=(True,))
+            thread.daemon = True
+            thread.start()
+
+    return data
+
+def _sync(data):
+    """
+    Add the keys created since the last look up to the filter, unless the
+    last look up is too recent. Returns ``True`` if the keys were looked up.
+    """
+    interval = getattr(settings, 'LOGINURL_BLOOM_SYNC_INTERVAL', 1)
+    margin = getattr(settings, 'LOGINURL_BLOOM_SYNC_MARGIN', 60)
+    with _lock:
+        if data.synced + interval > time.time():
+            return False
+        data.synced = time.time()
+        since = data.since - timedelta(seconds=margin)
+        data.since = timezone.now()
+
+    for key in _get_storage().iter_keys(since=since):
+        if key not in data:
+            data.add(key)
+    return True
+
+def might_exist(key):
+    """
+    Check if the key may be in the key storage. Returns ``False`` only if the
+    key is known not to be there.
+    """
+    data = get_filter()
+    if data is None or key in data:
+        return True
+
+    return _sync(data) and key in data
+
+def add(keys):
+    """
+    Add newly created keys to the filter of this process.
+    """
+    data = _filter
+    if data is not None:
+        for key in keys:
+            data.add(key)
+
+def stats():
+    """
+    Return the size and the expected false positive rate of the filter of
+    this process, or ``None`` if it is not built.
+    """
+    data = _filter
+    if data is None:
+        return None
+    return data.stats()
+
+def key_saved(sender, instance, created, **kwargs):
+    if created:
+        add([instance.key])
+
+post_save.connect(key_saved, sender=Key,
+                  dispatch_uid='loginurl.bloom.key_saved')
+post_save.connect(key_saved, sender=CompactKey,
+                  dispatch_uid='loginurl.bloom.key_saved')
@@ -0,0 +1,134 @@
+"""
+In process caches.
+"""
+import time
+import threading
+from collections import OrderedDict
+
+class LRUCache(object):
+    """
+    A thread safe least recently used cache.
+
+    The cache holds up to ``size`` entries. If ``ttl`` is not ``None``, the
+    entries expire ``ttl`` seconds after they are set. The number of cache
+    hits and misses are counted in ``hits`` and ``misses``.
+    """
+    def __init__(self, size, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return the value of ``key``, or ``None`` if it is not in the cache.
+        """
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+
+            if expires is not None and expires < time.time():
+                self.misses += 1
+                return None
+
+            self._data[key] = value, expires
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        expires = None
+        if self.ttl is not None:
+            expires = time.time() + self.ttl
+
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value, expires
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+class StripedCounter(object):
+    """
+    Thread safe counters following the ``add``, ``incr`` and ``get_many``
+    methods of Django caches.
+
+    The counters are split in ``stripes`` groups, each with its own lock, so
+    threads updating different counters rarely wait for each other. Counters
+    expire ``timeout`` seconds after they are added, and expired counters are
+    removed by ``prune``.
+    """
+    def __init__(self, stripes=16):
+        self._stripes = [({}, threading.Lock()) for i in range(stripes)]
+
+    def _stripe(self, key):
+        return self._stripes[hash(key) % len(self._stripes)]
+
+    def add(self, key, value, timeout=None):
+        data, lock = self._stripe(key)
+        expires = None
+        if timeout is not None:
+            expires = time.time() + timeout
+
+        with lock:
+            current = data.get(key)
+            if current is not None and (current[1] is None or
+                                        current[1] >= time.time()):
+                return False
+            data[key] = value, expires
+            return True
+
+    def incr(self, key, delta=1):
+        data, lock = self._stripe(key)
+        with lock:
+            try:
+                value, expires = data[key]
+            except KeyError:
+                raise ValueError("Key '{}' not found".format(key))
+            if expires is not None and expires < time.time():
+                raise ValueError("Key '{}' not found".format(key))
+            value += delta
+            data[key] = value, expires
+            return value
+
+    def get_many(self, keys):
+        values = {}
+        now = time.time()
+        for key in keys:
+            data, lock = self._stripe(key)
+            with lock:
+                current = data.get(key)
+            if current is not None and (current[1] is None or
+                                        current[1] >= now):
+                values[key] = current[0]
+        return values
+
+    def prune(self):
+        """
+        Remove the expired counters.
+        """
+        now = time.time()
+        for data, lock in self._stripes:
+            with lock:
+                for key in [key for key, (value, expires) in data.items()
+                            if expires is not None and expires < now]:
+                    del data[key]
+
+    def __len__(self):
+        return sum(len(data) for data, lock in self._stripes)
@@ -0,0 +1,24 @@
+from functools import wraps
+
+from django.http import HttpResponseForbidden
+
+from loginurl.middleware import get_key, authenticate
+
+def key_required(view):
+    """
+    Decorator for views that authenticates each request with a key, without
+    a session.
+
+    The key is taken from the ``key`` argument of the view if its URL pattern
+    has one, otherwise from the request, see ``middleware.get_key``. Requests
+    without a valid key get a ``403 Forbidden`` response.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key = kwargs.pop('key', None) or get_key(request)
+        if key is None or authenticate(request, key) is None:
+            return HttpResponseForbidden('Invalid key',
+                                         content_type='text/plain')
+        return view(request, *args, **kwargs)
+
+    return wrapper
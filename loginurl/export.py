@@ -0,0 +1,93 @@
+"""
+Export of login URLs, e.g. to hand them over to a mailing system.
+
+The keys are read in batches ordered by primary key, together with the email
+address of their user, so the memory used does not depend on the number of
+keys exported. The output is produced one batch at a time.
+"""
+from __future__ import unicode_literals
+
+import json
+import zlib
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+
+PLACEHOLDER = '0-placeholder'
+
+def url_template(base_url=''):
+    """
+    Return the parts of the login URL before and after the key, so that the
+    URLs of many keys can be built without calling ``reverse`` for each one.
+    """
+    url = reverse('loginurl-login', kwargs={'key': PLACEHOLDER})
+    prefix, suffix = url.split(PLACEHOLDER)
+    return base_url.rstrip('/') + prefix, suffix
+
+def iter_rows(queryset, base_url='', batch_size=None):
+    """
+    Yield lists of ``(email, login URL)`` pairs for the keys of a ``Key``
+    queryset, one list for each batch of ``batch_size`` keys
+    (``settings.LOGINURL_EXPORT_BATCH_SIZE`` or 1000 by default).
+    """
+    if batch_size is None:
+        batch_size = getattr(settings, 'LOGINURL_EXPORT_BATCH_SIZE', 1000)
+
+    prefix, suffix = url_template(base_url)
+    queryset = queryset.order_by('pk').values_list('pk', 'key', 'user__email')
+
+    last = 0
+    while True:
+        batch = list(queryset.filter(pk__gt=last)[:batch_size])
+        if not batch:
+            break
+        last = batch[-1][0]
+
+        yield [(email, prefix + key + suffix) for pk, key, email in batch]
+
+        if len(batch) < batch_size:
+            break
+
+def _csv_field(value):
+    if any(c in value for c in ',"\r\n'):
+        return '"{}"'.format(value.replace('"', '""'))
+    return value
+
+def _csv(batches):
+    yield 'email,url\r\n'
+    for rows in batches:
+        yield ''.join('{},{}\r\n'.format(_csv_field(email), _csv_field(url))
+                      for email, url in rows)
+
+def _jsonl(batches):
+    for rows in batches:
+        yield ''.join(json.dumps({'email': email, 'url': url}) + '\n'
+                      for email, url in rows)
+
+FORMATS = {
+    'csv': _csv,
+    'jsonl': _jsonl,
+}
+
+def gzip_chunks(chunks):
+    """
+    Compress text chunks into a gzip stream, yielding bytes.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+def iter_export(queryset, format='csv', base_url='', compress=False,
+                batch_size=None):
+    """
+    Yield the email addresses and login URLs of the keys of a ``Key``
+    queryset as ``csv`` or ``jsonl`` text, or gzip compressed bytes if
+    ``compress`` is ``True``.
+    """
+    chunks = FORMATS[format](iter_rows(queryset, base_url, batch_size))
+    if compress:
+        chunks = gzip_chunks(chunks)
+    return chunks
@@ -0,0 +1,40 @@
+from datetime import timedelta
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+class Command(BaseCommand):
+    help = "Remove old entries of the audit log."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', default=None,
+                    help='Remove entries older than this many days. '
+                         'Defaults to LOGINURL_AUDIT_RETENTION_DAYS or 90.'),
+        make_option('--batch-size', type='int', default=1000,
+                    help='Number of entries removed in each batch.'),
+    )
+
+    def handle(self, **options):
+        from loginurl.models import KeyEvent
+
+        days = options['days']
+        if days is None:
+            days = getattr(settings, 'LOGINURL_AUDIT_RETENTION_DAYS', 90)
+        before = timezone.now() - timedelta(days=days)
+        batch_size = options['batch_size']
+
+        count = 0
+        while True:
+            pks = list(KeyEvent.objects.filter(created__lt=before)
+                                       .order_by('pk')
+                                       .values_list('pk', flat=True)
+                                       [:batch_size])
+            if not pks:
+                break
+
+            KeyEvent.objects.filter(pk__in=pks).delete()
+            count += len(pks)
+
+        self.stdout.write('{} audit log entries removed'.format(count))
@@ -0,0 +1,180 @@
+import json
+import time
+from itertools import repeat
+from optparse import make_option
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import django
+from django.contrib.auth.models import User
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.client import RequestFactory
+
+class Rollback(Exception):
+    pass
+
+def percentile(values, percent):
+    """
+    Return the value below which ``percent`` percent of ``values`` fall.
+    """
+    values = sorted(values)
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
+
+def peak_memory():
+    """
+    Return the peak memory usage of the process since it started in
+    kilobytes, or ``None`` if it is not available.
+    """
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def measure_peak_memory(function):
+    """
+    Call ``function`` and return its result and the peak memory allocated by
+    Python objects during the call in kilobytes, or ``None`` if it is not
+    available.
+    """
+    if tracemalloc is None or tracemalloc.is_tracing():
+        return function(), None
+
+    tracemalloc.start()
+    try:
+        result = function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, peak // 1024
+
+def login_request(key):
+    """
+    Build a request for the ``login`` view, with a session.
+    """
+    request = RequestFactory().get('/loginurl/{}/'.format(key))
+    SessionMiddleware().process_request(request)
+    return request
+
+class Command(BaseCommand):
+    help = ("Measure the cost of creating keys, logging in and cleaning up. "
+            "Everything is run in a transaction that is rolled back at the "
+            "end, but it should still be run against a test database.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--create', type='int', default=1000,
+                    help='Number of keys created to measure key creation.'),
+        make_option('--sizes', default='10000',
+                    help='Comma separated numbers of keys in the table when '
+                         'logging in, e.g. 10000,1000000.'),
+        make_option('--logins', type='int', default=1000,
+                    help='Number of logins measured for each table size.'),
+        make_option('--output', default=None,
+                    help='Write the results to this file instead of the '
+                         'standard output.'),
+    )
+
+    def handle(self, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+
+        results = {
+            'django': django.get_version(),
+            'database': connection.vendor,
+        }
+        try:
+            with transaction.atomic():
+                user = User.objects.create_user('loginurl-benchmark')
+                results['create'] = self.create(user, options['create'])
+                results['create_many'] = self.create_many(user,
+                                                          options['create'])
+                results['login'] = [self.login(user, size, options['logins'])
+                                    for size in sizes]
+                results['cleanup'] = self.cleanup()
+                raise Rollback
+        except Rollback:
+            pass
+
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
+
+    def create(self, user, count):
+        from loginurl import utils
+
+        start = time.time()
+        for i in range(count):
+            utils.create(user)
+        duration = time.time() - start
+
+        return {'keys': count, 'keys_per_second': count / duration}
+
+    def create_many(self, user, count):
+        from loginurl import utils
+
+        start = time.time()
+        for data in utils.create_many(repeat(user, count)):
+            pass
+        duration = time.time() - start
+
+        return {'keys': count, 'keys_per_second': count / duration}
+
+    def login(self, user, size, count):
+        from loginurl import utils, views, metrics
+        from loginurl.models import Key
+
+        # Fill the table up to the requested size, then create the keys used
+        # to log in.
+        missing = size - Key.objects.count()
+        if missing > 0:
+            for data in utils.create_many(repeat(user, missing)):
+                pass
+        keys = [data.key for data in utils.create_many(repeat(user, count))]
+
+        durations = []
+        queries = 0
+        for key in keys:
+            request = login_request(key)
+            with metrics.QueryCounter() as counter:
+                start = time.time()
+                views.login(request, key)
+                durations.append(time.time() - start)
+            queries += counter.count
+
+        return {
+            'table_size': Key.objects.count(),
+            'logins': count,
+            'p50_ms': percentile(durations, 50) * 1000,
+            'p99_ms': percentile(durations, 99) * 1000,
+            'queries_per_login': float(queries) / count,
+        }
+
+    def cleanup(self):
+        from loginurl import utils
+        from loginurl.models import Key
+
+        Key.objects.update(usage_left=0)
+
+        start = time.time()
+        count, peak = measure_peak_memory(utils.cleanup)
+        duration = time.time() - start
+
+        # The peak of the process is usually reached while filling the table,
+        # so it only bounds the memory used by the clean up.
+        return {
+            'rows': count,
+            'rows_per_second': count / duration if duration else None,
+            'peak_memory_kb': peak,
+            'process_peak_memory_kb': peak_memory(),
+        }
@@ -1,9 +1,149 @@
-from django.core.management.base import NoArgsCommand
+import os
+import json
+import time
+from datetime import timedelta
+from optparse import make_option
 
-class Command(NoArgsCommand):
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+POSITION_KEY = 'loginurl:cleanup:position'
+POSITION_TIMEOUT = 30 * 86400
+
+class Command(BaseCommand):
     help = "Clean up expired one time keys."
 
-    def handle_noargs(self, **options):
-        from loginurl import utils
-        utils.cleanup()
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=None,
+                    help='Number of keys removed in each batch.'),
+        make_option('--sleep', type='float', default=None,
+                    help='Seconds to sleep between batches.'),
+        make_option('--max-seconds', type='float', default=None,
+                    help='Stop after this many seconds.'),
+        make_option('--max-rows', type='int', default=None,
+                    help='Stop after removing this many keys.'),
+        make_option('--older-than', type='int', default=None,
+                    help='Also remove valid keys created more than this '
+                         'many days ago.'),
+        make_option('--dry-run', action='store_true', default=False,
+                    help='Only count the keys that would be removed.'),
+        make_option('--restart', action='store_true', default=False,
+                    help='Ignore the position saved by an interrupted run.'),
+        make_option('--position-file', default=None,
+                    help='Save the position of an interrupted run in this '
+                         'file instead of the cache.'),
+    )
+
+    def handle(self, **options):
+        from loginurl import audit
+        from loginurl.storage import get_storage
+
+        storage = get_storage()
+        verbosity = int(options['verbosity'])
+
+        older_than = None
+        if options['older_than'] is not None:
+            older_than = timezone.now() - timedelta(days=options['older_than'])
+
+        if options['dry_run']:
+            count = storage.count_invalid(older_than)
+            self.stdout.write('{} keys would be removed'.format(count))
+            return
+
+        sleep = options['sleep']
+        if sleep is None:
+            sleep = getattr(settings, 'LOGINURL_CLEANUP_SLEEP', 0)
+
+        # The position of an interrupted run is kept in a file or in the
+        # cache, so the next run continues from there instead of starting
+        # over.
+        self.position_file = options['position_file']
+        if self.position_file is None:
+            self.position_file = getattr(settings,
+                                         'LOGINURL_CLEANUP_POSITION_FILE',
+                                         None)
+        start = None
+        if not options['restart']:
+            start = self.load_position()
+
+        count = 0
+        finished = True
+        started = time.time()
+        batches = storage.iter_cleanup(options['batch_size'], older_than,
+                                       start)
+        for position, removed in batches:
+            count += removed
+            self.save_position(position)
+
+            duration = time.time() - started
+            if verbosity > 1:
+                self.stdout.write('{} keys removed, {:.0f} keys/s'.format(
+                    count, count / duration if duration else 0))
+
+            if options['max_rows'] is not None and \
+               count >= options['max_rows']:
+                finished = False
+                break
+            if options['max_seconds'] is not None and \
+               duration >= options['max_seconds']:
+                finished = False
+                break
+
+            if sleep:
+                time.sleep(sleep)
+
+        if finished:
+            self.save_position(None)
+        audit.record(audit.CLEANUP, detail='{} keys removed'.format(count))
+
+        duration = time.time() - started
+        self.stdout.write('{} keys removed in {:.3f} seconds ({:.0f} keys/s)'
+                          .format(count, duration,
+                                  count / duration if duration else 0))
+        if not finished:
+            self.stdout.write('Stopped before the end, the next run will '
+                              'continue from here')
+            cache = self.cache()
+            if self.position_file is None and \
+               isinstance(cache, (LocMemCache, DummyCache)):
+                self.stderr.write('The position is saved in a cache that is '
+                                  'not kept between runs, use '
+                                  '--position-file or '
+                                  'LOGINURL_CLEANUP_POSITION_FILE to resume.')
+
+    def cache(self):
+        return get_cache(getattr(settings, 'LOGINURL_CACHE', 'default'))
+
+    def load_position(self):
+        if self.position_file is None:
+            return self.cache().get(POSITION_KEY)
+
+        try:
+            with open(self.position_file) as f:
+                return json.load(f)
+        except IOError:
+            return None
 
+    def save_position(self, position):
+        """
+        Save the position reached, or forget it if ``position`` is ``None``.
+        """
+        if self.position_file is None:
+            if position is None:
+                self.cache().delete(POSITION_KEY)
+            else:
+                self.cache().set(POSITION_KEY, position, POSITION_TIMEOUT)
+        elif position is None:
+            if os.path.exists(self.position_file):
+                os.remove(self.position_file)
+        else:
+            # Written to a temporary file first, so an interrupted write does
+            # not leave a truncated position behind.
+            name = self.position_file + '.tmp'
+            with open(name, 'w') as f:
+                json.dump(position, f)
+            os.rename(name, self.position_file)
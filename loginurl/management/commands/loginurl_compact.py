@@ -0,0 +1,69 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+    help = "Copy the keys in the Key model to the CompactKey model."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=1000,
+                    help='Number of keys copied in each batch.'),
+        make_option('--delete', action='store_true', default=False,
+                    help='Delete the keys from the Key model once copied. '
+                         'Malformed keys are kept.'),
+    )
+
+    def handle(self, **options):
+        from loginurl.models import Key, CompactKey, KeyTarget
+        from loginurl.utils import split_key
+
+        batch_size = options['batch_size']
+        targets = {}
+
+        count = 0
+        skipped = 0
+        last = 0
+        while True:
+            batch = list(Key.objects.filter(pk__gt=last).order_by('pk')
+                                    [:batch_size])
+            if not batch:
+                break
+            last = batch[-1].pk
+
+            data = []
+            pks = []
+            for item in batch:
+                try:
+                    uid, token = split_key(item.key)
+                except ValueError:
+                    skipped += 1
+                    continue
+
+                target = None
+                if item.next is not None:
+                    target = targets.get(item.next)
+                    if target is None:
+                        target = KeyTarget.objects.get_or_create(
+                            url=item.next)[0]
+                        targets[item.next] = target
+
+                pks.append(item.pk)
+                data.append(CompactKey(user_id=item.user_id, token=token,
+                                       created=item.created,
+                                       usage_left=item.usage_left,
+                                       expires=item.expires, target=target))
+
+            # Keys copied by a previous run are not copied again.
+            existing = set(bytes(token) for token in CompactKey.objects
+                           .filter(token__in=[item.token for item in data])
+                           .values_list('token', flat=True))
+            data = [item for item in data if bytes(item.token) not in existing]
+
+            CompactKey.objects.bulk_create(data)
+            count += len(data)
+
+            if options['delete']:
+                Key.objects.filter(pk__in=pks).delete()
+
+        self.stdout.write('{} keys copied, {} malformed keys skipped'.format(
+            count, skipped))
@@ -0,0 +1,71 @@
+import io
+from datetime import timedelta
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from django.utils import timezone
+
+class Command(BaseCommand):
+    help = ("Export the email addresses of users and their login URLs, as "
+            "CSV or JSON lines.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', default='csv', choices=['csv', 'jsonl'],
+                    help='Output format, csv or jsonl.'),
+        make_option('--output', default=None,
+                    help='Write to this file instead of the standard output.'),
+        make_option('--gzip', action='store_true', default=False,
+                    help='Compress the output with gzip. Needs --output.'),
+        make_option('--base-url', default='',
+                    help='Scheme and host prepended to the login URLs, e.g. '
+                         'https://example.com.'),
+        make_option('--days', type='int', default=None,
+                    help='Only export keys created in the last DAYS days.'),
+        make_option('--next', default=None,
+                    help='Only export keys redirecting to this URL.'),
+        make_option('--valid', action='store_true', default=False,
+                    help='Only export keys that are still valid.'),
+        make_option('--batch-size', type='int', default=None,
+                    help='Number of keys read in each batch.'),
+    )
+
+    def handle(self, **options):
+        from loginurl.export import iter_export
+        from loginurl.models import Key
+        from loginurl.storage import get_storage
+
+        if options['gzip'] and not options['output']:
+            raise CommandError('--gzip needs --output.')
+        if getattr(get_storage(), 'model', None) is not Key:
+            raise CommandError('Only keys stored in the Key model can be '
+                               'exported, see LOGINURL_STORAGE.')
+
+        queryset = Key.objects.all()
+        if options['days'] is not None:
+            since = timezone.now() - timedelta(days=options['days'])
+            queryset = queryset.filter(created__gte=since)
+        if options['next'] is not None:
+            queryset = queryset.filter(next=options['next'])
+        if options['valid']:
+            queryset = queryset.filter(Q(usage_left__isnull=True) |
+                                       Q(usage_left__gt=0),
+                                       Q(expires__isnull=True) |
+                                       Q(expires__gte=timezone.now()))
+
+        chunks = iter_export(queryset, options['format'],
+                             options['base_url'], options['gzip'],
+                             options['batch_size'])
+
+        if not options['output']:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
+        elif options['gzip']:
+            with open(options['output'], 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+        else:
+            with io.open(options['output'], 'w', encoding='utf-8',
+                         newline='') as f:
+                for chunk in chunks:
+                    f.write(chunk)
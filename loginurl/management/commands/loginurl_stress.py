@@ -0,0 +1,161 @@
+import json
+import time
+import threading
+from itertools import repeat
+from optparse import make_option
+
+from django.contrib.auth.models import User, AnonymousUser
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, DatabaseError
+
+from loginurl.management.commands.loginurl_benchmark import percentile, \
+     login_request
+
+SCENARIOS = ('one-time', 'multi-use', 'distinct')
+
+class Command(BaseCommand):
+    help = ("Log in concurrently from many threads with shared one time keys, "
+            "shared multi-use keys and distinct keys, and check that no key "
+            "is used more times than allowed. Keys are created in the "
+            "database and removed at the end, so this should be run against "
+            "a test database, e.g. a file-backed SQLite or a local "
+            "PostgreSQL.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--threads', type='int', default=8,
+                    help='Number of threads logging in at the same time.'),
+        make_option('--attempts', type='int', default=100,
+                    help='Number of log ins of each thread in each scenario.'),
+        make_option('--uses', type='int', default=None,
+                    help='Usages of the shared multi-use key. Defaults to '
+                         'half of the log ins.'),
+        make_option('--scenarios', default=','.join(SCENARIOS),
+                    help='Comma separated scenarios to run, among '
+                         'one-time, multi-use and distinct.'),
+        make_option('--output', default=None,
+                    help='Write the results to this file instead of the '
+                         'standard output.'),
+    )
+
+    def handle(self, **options):
+        from loginurl import utils
+
+        threads = options['threads']
+        attempts = options['attempts']
+        scenarios = options['scenarios'].split(',')
+        for scenario in scenarios:
+            if scenario not in SCENARIOS:
+                raise CommandError('Unknown scenario {}'.format(scenario))
+
+        if threads > 1 and connection.vendor == 'sqlite' and \
+           connection.settings_dict['NAME'] in ('', ':memory:'):
+            raise CommandError('An in-memory SQLite database cannot be shared '
+                               'by threads, use a file-backed database.')
+
+        total = threads * attempts
+        uses = options['uses']
+        if uses is None:
+            uses = max(total // 2, 1)
+
+        user = User.objects.get_or_create(username='loginurl-stress')[0]
+        results = {
+            'database': connection.vendor,
+            'threads': threads,
+        }
+        try:
+            for scenario in scenarios:
+                if scenario == 'one-time':
+                    keys = [utils.create(user, usage_left=1).key] * total
+                    allowed = 1
+                elif scenario == 'multi-use':
+                    keys = [utils.create(user, usage_left=uses).key] * total
+                    allowed = uses
+                else:
+                    keys = [data.key for data in
+                            utils.create_many(repeat(user, total))]
+                    allowed = total
+
+                result = self.run(keys, threads)
+                result['allowed'] = allowed
+                results[scenario] = result
+        finally:
+            # Deleting the user also deletes its keys.
+            user.delete()
+
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
+
+        over = [scenario for scenario in scenarios
+                if results[scenario]['logins'] > results[scenario]['allowed']]
+        if over:
+            raise CommandError('Keys used more times than allowed in: '
+                               '{}'.format(', '.join(over)))
+
+    def run(self, keys, threads):
+        """
+        Log in with the keys, split between ``threads`` threads. The calling
+        thread is one of them.
+        """
+        chunks = [keys[i::threads] for i in range(threads)]
+        stats = {'durations': [], 'logins': 0, 'lock_errors': 0, 'errors': 0}
+        lock = threading.Lock()
+
+        workers = [threading.Thread(target=self.work,
+                                    args=(chunk, stats, lock, True))
+                   for chunk in chunks[1:]]
+        start = time.time()
+        for worker in workers:
+            worker.start()
+        self.work(chunks[0], stats, lock)
+        for worker in workers:
+            worker.join()
+        duration = time.time() - start
+
+        durations = stats['durations'] or [0]
+        return {
+            'attempts': len(keys),
+            'logins': stats['logins'],
+            'logins_per_second': stats['logins'] / duration,
+            'lock_errors': stats['lock_errors'],
+            'errors': stats['errors'],
+            'p50_ms': percentile(durations, 50) * 1000,
+            'p99_ms': percentile(durations, 99) * 1000,
+            'max_ms': max(durations) * 1000,
+        }
+
+    def work(self, keys, stats, lock, close=False):
+        from loginurl import views
+
+        durations = []
+        logins = lock_errors = errors = 0
+        try:
+            for key in keys:
+                request = login_request(key)
+                request.user = AnonymousUser()
+                start = time.time()
+                try:
+                    views.login(request, key)
+                except DatabaseError as e:
+                    message = str(e).lower()
+                    if 'lock' in message or 'timeout' in message:
+                        lock_errors += 1
+                    else:
+                        errors += 1
+                    continue
+                finally:
+                    durations.append(time.time() - start)
+
+                if request.user.is_authenticated():
+                    logins += 1
+        finally:
+            with lock:
+                stats['durations'].extend(durations)
+                stats['logins'] += logins
+                stats['lock_errors'] += lock_errors
+                stats['errors'] += errors
+            if close:
+                connection.close()
@@ -0,0 +1,150 @@
+"""
+Instrumentation of the log in flow.
+
+The stages of the ``login`` view, ``utils.create`` and ``utils.cleanup`` send
+the ``signals.stage_finished`` signal with their duration and number of
+database queries, and the outcome of each key check sends the
+``signals.key_checked`` signal. Stages are only measured if the signal has
+receivers. The outcomes are also counted in ``outcomes``.
+
+The lookups sent to the read database by the authentication backend are
+counted in ``routes``: ``replica`` for the ones found there, ``fallback`` for
+the ones that had to be looked up again on the primary database.
+
+``StatsdAdapter`` forwards both signals to a statsd client.
+"""
+import time
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+
+from loginurl import signals
+
+SUCCESS = 'success'
+INVALID = 'invalid'
+EXPIRED = 'expired'
+EXHAUSTED = 'exhausted'
+
+outcomes = defaultdict(int)
+routes = defaultdict(int)
+_lock = threading.Lock()
+
+class QueryCounter(object):
+    """
+    A context manager counting the database queries of the code in a
+    ``with`` block on all the databases. The number of queries is in
+    ``count`` at the end of the block.
+
+    Queries are only logged in ``connection.queries`` while counting, and
+    removed afterwards, unless they are logged anyway because of
+    ``settings.DEBUG``.
+    """
+    def __init__(self):
+        self.count = None
+        self._states = []
+
+    def __enter__(self):
+        for conn in connections.all():
+            forced = not self._is_logging(conn)
+            self._states.append((conn, len(conn.queries), forced,
+                                 conn.use_debug_cursor))
+            if forced:
+                conn.use_debug_cursor = True
+        return self
+
+    def __exit__(self, *exc_info):
+        self.count = 0
+        for conn, initial, forced, use_debug_cursor in self._states:
+            self.count += len(conn.queries) - initial
+            if forced:
+                del conn.queries[initial:]
+                conn.use_debug_cursor = use_debug_cursor
+        self._states = []
+
+    def _is_logging(self, conn):
+        if conn.use_debug_cursor is None:
+            return settings.DEBUG
+        return conn.use_debug_cursor
+
+@contextmanager
+def measure(stage):
+    """
+    Measure the duration and database queries of the code in a ``with``
+    block and send ``signals.stage_finished``. The queries of all the
+    databases are counted, see ``QueryCounter``.
+    """
+    if not signals.stage_finished.has_listeners():
+        yield
+        return
+
+    with QueryCounter() as queries:
+        start = time.time()
+        yield
+        duration = time.time() - start
+
+    signals.stage_finished.send(sender=None, stage=stage, duration=duration,
+                                queries=queries.count)
+
+def report(key, outcome):
+    """
+    Count the outcome of a key check and send ``signals.key_checked``.
+    """
+    with _lock:
+        outcomes[outcome] += 1
+
+    signals.key_checked.send(sender=None, key=key, outcome=outcome)
+
+def count_route(route):
+    """
+    Count a lookup routed to the read database, see ``routes``.
+    """
+    with _lock:
+        routes[route] += 1
+
+class StatsdAdapter(object):
+    """
+    Forward the instrumentation signals to a statsd client.
+
+    The client needs the ``timing(name, milliseconds)`` and
+    ``incr(name, count=1)`` methods of the common statsd clients. Stages are
+    reported as ``<prefix>.<stage>`` timings and ``<prefix>.<stage>.queries``
+    counters, and outcomes as ``<prefix>.key.<outcome>`` counters.
+    """
+    def __init__(self, client, prefix='loginurl'):
+        self.client = client
+        self.prefix = prefix
+
+    def connect(self):
+        signals.stage_finished.connect(self.stage_finished, weak=False,
+                                       dispatch_uid=id(self))
+        signals.key_checked.connect(self.key_checked, weak=False,
+                                    dispatch_uid=id(self))
+
+    def disconnect(self):
+        signals.stage_finished.disconnect(dispatch_uid=id(self))
+        signals.key_checked.disconnect(dispatch_uid=id(self))
+
+    def stage_finished(self, stage, duration, queries, **kwargs):
+        name = '{}.{}'.format(self.prefix, stage)
+        self.client.timing(name, duration * 1000)
+        self.client.incr(name + '.queries', queries)
+
+    def key_checked(self, outcome, **kwargs):
+        self.client.incr('{}.key.{}'.format(self.prefix, outcome))
+
+class MemoryClient(object):
+    """
+    A statsd client keeping the metrics in memory, e.g. for tests.
+    """
+    def __init__(self):
+        self.timings = defaultdict(list)
+        self.counters = defaultdict(int)
+
+    def timing(self, name, value):
+        self.timings[name].append(value)
+
+    def incr(self, name, count=1):
+        self.counters[name] += count
@@ -0,0 +1,65 @@
+"""
+Authentication of single requests with a key, without a session.
+"""
+from django.conf import settings
+from django.contrib import auth
+
+from loginurl import throttling, metrics, audit
+
+def get_key(request):
+    """
+    Return the key sent with a request, or ``None``.
+
+    The key is read from the ``settings.LOGINURL_HEADER`` request header
+    (``HTTP_X_LOGINURL_KEY`` by default, i.e. ``X-LoginUrl-Key``), then from
+    the ``settings.LOGINURL_PARAMETER`` query string parameter
+    (``loginurl_key`` by default). Either can be disabled by setting it to
+    ``None``.
+    """
+    header = getattr(settings, 'LOGINURL_HEADER', 'HTTP_X_LOGINURL_KEY')
+    parameter = getattr(settings, 'LOGINURL_PARAMETER', 'loginurl_key')
+
+    key = None
+    if header:
+        key = request.META.get(header)
+    if not key and parameter:
+        key = request.GET.get(parameter)
+    return key or None
+
+def authenticate(request, key):
+    """
+    Authenticate a request with a key, for this request only.
+
+    The key is validated and consumed like in the ``login`` view, and the user
+    is set as ``request.user``, but no session is created and the user is not
+    logged in for the next requests. Returns the user, or ``None`` if the key
+    is not valid or there have been too many failed attempts.
+    """
+    if throttling.is_throttled(request, key):
+        audit.record(audit.FAILURE, key, request=request, detail='throttled')
+        return None
+
+    with metrics.measure('stateless'):
+        user = auth.authenticate(key=key)
+    if user is None:
+        throttling.add_failure(request, key)
+        audit.record(audit.FAILURE, key, request=request)
+        return None
+
+    request.user = user
+    audit.record(audit.SUCCESS, key, user, request)
+    return user
+
+class LoginUrlMiddleware(object):
+    """
+    Authenticate requests sending a key, see ``get_key``, for that request
+    only.
+
+    This middleware has to be placed after
+    ``django.contrib.auth.middleware.AuthenticationMiddleware``. Requests with
+    an invalid key are left as they are.
+    """
+    def process_request(self, request):
+        key = get_key(request)
+        if key is not None:
+            authenticate(request, key)
@@ -1,33 +1,77 @@
 from __future__ import unicode_literals
 
-from django.db import models
+from django.conf import settings
+from django.db import models, router
+from django.db.models import F
 from django.contrib.auth.models import User
 from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
+from django.utils.http import int_to_base36
 
-from loginurl.utils import create_key
+from loginurl import metrics, usage
+from loginurl.utils import create_key, split_key, bytes_to_token
 
-@python_2_unicode_compatible
-class Key(models.Model):
-    """
-    A simple key store.
-    """
-    user = models.ForeignKey(User)
-    key = models.CharField(max_length=40, unique=True, blank=True)
-    created = models.DateTimeField(auto_now_add=True)
-    usage_left = models.IntegerField(null=True, blank=True, default=1)
-    expires = models.DateTimeField(null=True, blank=True)
-    next = models.CharField(null=True, blank=True, max_length=200)
+class KeyManager(models.Manager):
+    def get_key(self, key, using=None):
+        """
+        Return the key with its user. Raises ``DoesNotExist`` if there is no
+        such key.
+        """
+        return self.db_manager(using).select_related('user').get(key=key)
 
-    def __str__(self):
-        return '{} ({})'.format(self.key, self.user.username)
+    def lookup(self, key):
+        """
+        Return the key with its user, reading from the database set in
+        ``settings.LOGINURL_READ_DATABASE`` if any.
 
-    def save(self, *args, **kwargs):
-        if not self.key:
-            self.key = create_key(self.user)
+        A key that is not found there, e.g. because the read database lags
+        behind, is looked up again on the database the key is written to.
+        """
+        read = getattr(settings, 'LOGINURL_READ_DATABASE', None)
+        if read is not None:
+            try:
+                data = self.get_key(key, using=read)
+                metrics.count_route('replica')
+                return data
+            except self.model.DoesNotExist:
+                metrics.count_route('fallback')
 
-        return super(Key, self).save(*args, **kwargs)
+        return self.get_key(key, using=router.db_for_write(self.model))
+
+    def consume(self, key):
+        """
+        Validate a key and spend one of its usages.
+
+        The key and its user are fetched in a single query, possibly from a
+        read database, see ``lookup``. If the key is valid, the usage counter
+        is decremented with a conditional ``UPDATE`` on the primary database,
+        so that concurrent requests cannot spend the same usage twice.
+
+        Returns the ``Key`` instance, with its ``user`` already loaded, or
+        ``None`` if the key does not exist, is no longer valid or was spent by
+        a concurrent request.
+        """
+        try:
+            data = self.lookup(key)
+        except self.model.DoesNotExist:
+            metrics.report(key, metrics.INVALID)
+            return None
 
+        reason = data.invalid_reason()
+        if reason is not None:
+            metrics.report(key, reason)
+            return None
+
+        if data.usage_left is not None and not data.update_usage():
+            metrics.report(key, metrics.EXHAUSTED)
+            return None
+
+        return data
+
+class KeyMixin(object):
+    """
+    Validation and usage counting shared by the key models.
+    """
     def is_valid(self):
         """
         Check if the key is valid.
@@ -36,19 +80,161 @@ class Key(models.Model):
         properties of the key. If both are ``None`` then the key is always
         valid.
         """
+        return self.invalid_reason() is None
+
+    def invalid_reason(self):
+        """
+        Return why the key is not valid, either ``metrics.EXHAUSTED`` or
+        ``metrics.EXPIRED``, or ``None`` if it is valid.
+        """
         if self.usage_left is not None and self.usage_left <= 0:
-            return False
+            return metrics.EXHAUSTED
         if self.expires is not None and self.expires < timezone.now():
-            return False
-        return True
+            return metrics.EXPIRED
+        return None
 
     def update_usage(self):
         """
         Update key usage counter.
 
-        This only relevant if the ``usage_left`` property is used.
+        This only relevant if the ``usage_left`` property is used. The counter
+        is decremented in the database with a single conditional ``UPDATE``, so
+        concurrent calls never bring it below zero. Returns ``True`` if a usage
+        was spent.
+
+        Keys with many usages left may be counted by ``usage.spend`` instead,
+        see ``loginurl.usage``.
         """
-        if self.usage_left is not None and self.usage_left > 0:
-            self.usage_left -= 1
-            self.save()
+        if self.usage_left is None or self.usage_left <= 0:
+            return False
+
+        if usage.is_enabled(self):
+            spent = usage.spend(self)
+            if spent is not None:
+                return spent
 
+        manager = type(self)._default_manager
+        updated = manager.filter(pk=self.pk, usage_left__gt=0) \
+                         .update(usage_left=F('usage_left') - 1)
+        if not updated:
+            self.usage_left = 0
+            return False
+
+        self.usage_left -= 1
+        return True
+
+@python_2_unicode_compatible
+class Key(KeyMixin, models.Model):
+    """
+    A simple key store.
+    """
+    user = models.ForeignKey(User)
+    key = models.CharField(max_length=40, unique=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+    usage_left = models.IntegerField(null=True, blank=True, default=1,
+                                     db_index=True)
+    expires = models.DateTimeField(null=True, blank=True, db_index=True)
+    next = models.CharField(null=True, blank=True, max_length=200)
+
+    objects = KeyManager()
+
+    class Meta:
+        index_together = [('user', 'created'),
+                          ('user', 'next', 'usage_left', 'expires')]
+
+    def __str__(self):
+        return '{} ({})'.format(self.key, self.user.username)
+
+    def save(self, *args, **kwargs):
+        if not self.key:
+            self.key = create_key(self.user)
+
+        return super(Key, self).save(*args, **kwargs)
+
+class CompactKeyManager(KeyManager):
+    def get_key(self, key, using=None):
+        try:
+            uid, token = split_key(key)
+        except ValueError:
+            raise self.model.DoesNotExist
+
+        return self.db_manager(using).select_related('user', 'target') \
+                                     .get(token=token, user=uid)
+
+@python_2_unicode_compatible
+class KeyTarget(models.Model):
+    """
+    A redirect target shared by compact keys.
+    """
+    url = models.CharField(max_length=200, unique=True)
+
+    def __str__(self):
+        return self.url
+
+@python_2_unicode_compatible
+class CompactKey(KeyMixin, models.Model):
+    """
+    A key store with a compact schema.
+
+    The token part of the key is stored as raw bytes instead of text, and the
+    ``next`` URLs are shared through ``KeyTarget``. See
+    ``storage.CompactModelStorage``.
+    """
+    user = models.ForeignKey(User)
+    token = models.BinaryField(max_length=20, unique=True)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+    usage_left = models.IntegerField(null=True, blank=True, default=1,
+                                     db_index=True)
+    expires = models.DateTimeField(null=True, blank=True, db_index=True)
+    target = models.ForeignKey(KeyTarget, null=True, blank=True)
+
+    objects = CompactKeyManager()
+
+    class Meta:
+        index_together = [('user', 'created'),
+                          ('user', 'target', 'usage_left', 'expires')]
+
+    def __str__(self):
+        return '{} ({})'.format(self.key, self.user.username)
+
+    @property
+    def key(self):
+        return '{}-{}'.format(int_to_base36(self.user_id),
+                              bytes_to_token(self.token))
+
+    @property
+    def next(self):
+        if self.target_id is None:
+            return None
+        return self.target.url
+
+@python_2_unicode_compatible
+class KeyEvent(models.Model):
+    """
+    An entry of the audit log, see ``loginurl.audit``.
+
+    The key is stored as its digest, see ``audit.digest``, so the log cannot
+    be used to log in.
+    """
+    ISSUED = 'issued'
+    SUCCESS = 'success'
+    FAILURE = 'failure'
+    CLEANUP = 'cleanup'
+    ACTIONS = (
+        (ISSUED, 'Issued'),
+        (SUCCESS, 'Log in'),
+        (FAILURE, 'Failed log in'),
+        (CLEANUP, 'Clean up'),
+    )
+
+    action = models.CharField(max_length=10, choices=ACTIONS)
+    key = models.CharField('key digest', max_length=40, blank=True,
+                           db_index=True)
+    user = models.ForeignKey(User, null=True, blank=True, db_constraint=False,
+                             on_delete=models.DO_NOTHING)
+    created = models.DateTimeField(default=timezone.now, db_index=True)
+    ip = models.GenericIPAddressField(null=True, blank=True)
+    detail = models.CharField(max_length=200, blank=True)
+
+    def __str__(self):
+        return '{} {} {}'.format(self.created, self.action, self.key)
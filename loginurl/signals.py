@@ -0,0 +1,10 @@
+from django.dispatch import Signal
+
+# Sent when a measured stage of the log in, key creation or clean up is done.
+# ``duration`` is in seconds and ``queries`` is the number of database queries
+# made during the stage.
+stage_finished = Signal(providing_args=['stage', 'duration', 'queries'])
+
+# Sent when a key is checked by the authentication backend. ``outcome`` is one
+# of ``success``, ``invalid``, ``expired`` or ``exhausted``.
+key_checked = Signal(providing_args=['key', 'outcome'])
@@ -0,0 +1,847 @@
+"""
+Key storages.
+
+A key storage keeps the keys created by ``utils.create`` and validates them
+when they are used. The storage in use is selected by the
+``settings.LOGINURL_STORAGE`` setting, which is the dotted path of a storage
+class. By default, the keys are stored in the ``Key`` model.
+"""
+import re
+import time
+import hashlib
+import operator
+from datetime import timedelta
+from functools import reduce
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import get_cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, router, transaction
+from django.db.models import Q
+from django.utils import six, timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.http import int_to_base36, base36_to_int
+from django.utils.importlib import import_module
+
+from loginurl import metrics
+from loginurl.models import Key, CompactKey, KeyTarget
+from loginurl.utils import create_key, create_keys, split_key, \
+     bytes_to_token, _to_timestamp
+
+DEFAULT_STORAGE = 'loginurl.storage.ModelStorage'
+
+_storages = {}
+
+def get_storage(path=None):
+    """
+    Return the storage instance for the given dotted path.
+
+    If ``path`` is ``None``, the storage configured in
+    ``settings.LOGINURL_STORAGE`` is returned.
+    """
+    if path is None:
+        path = getattr(settings, 'LOGINURL_STORAGE', DEFAULT_STORAGE)
+
+    storage = _storages.get(path)
+    if storage is None:
+        module, attr = path.rsplit('.', 1)
+        try:
+            cls = getattr(import_module(module), attr)
+        except (ImportError, AttributeError) as e:
+            raise ImproperlyConfigured(
+                'Error loading key storage {}: {}'.format(path, e))
+
+        storage = _storages[path] = cls()
+
+    return storage
+
+def estimate_rows(connection, table):
+    """
+    Return the number of rows in a table as estimated by the database
+    statistics, or ``None`` if no estimate is available.
+    """
+    if connection.vendor == 'postgresql':
+        sql = 'SELECT reltuples FROM pg_class WHERE relname = %s'
+    elif connection.vendor == 'mysql':
+        sql = ('SELECT table_rows FROM information_schema.tables '
+               'WHERE table_schema = DATABASE() AND table_name = %s')
+    else:
+        return None
+
+    cursor = connection.cursor()
+    cursor.execute(sql, [table])
+    row = cursor.fetchone()
+    if row is None or row[0] is None:
+        return None
+    return max(int(row[0]), 0)
+
+class BaseStorage(object):
+    """
+    Base class for key storages.
+
+    Subclasses have to implement ``create`` and ``consume``.
+    """
+    def create(self, user, usage_left, expires, next):
+        """
+        Create and store a key for a user. Returns a ``Key`` instance.
+        """
+        raise NotImplementedError
+
+    def create_many(self, users, usage_left, expires, next):
+        """
+        Create and store keys for a list of users. Returns a list of ``Key``
+        instances.
+        """
+        return [self.create(user, usage_left, expires, next)
+                for user in users]
+
+    def get_or_create(self, user, usage_left, expires, next):
+        """
+        Return a valid key of a user with the same ``usage_left``, ``next``
+        and an expiry time not much earlier than ``expires``, or create one.
+        Returns a ``(key, created)`` pair.
+
+        By default, a new key is always created.
+        """
+        return self.create(user, usage_left, expires, next), True
+
+    def consume(self, key):
+        """
+        Validate a key and spend one of its usages.
+
+        Returns a ``Key`` instance or ``None`` if the key does not exist or is
+        no longer valid.
+        """
+        raise NotImplementedError
+
+    def active_keys(self, user):
+        """
+        Return the valid keys of a user, newest first.
+        """
+        raise NotImplementedError
+
+    def revoke(self, user):
+        """
+        Make all the keys of a user invalid. Returns the number of keys
+        revoked.
+        """
+        raise NotImplementedError
+
+    def evict(self, user, keep):
+        """
+        Revoke the valid keys of a user except the ``keep`` newest ones.
+        """
+        raise NotImplementedError
+
+    #: A function returning an iterator of the stored keys, or only the ones
+    #: created at or after the datetime ``since``. Used by ``loginurl.bloom``,
+    #: ``None`` if not supported.
+    iter_keys = None
+
+    def iter_cleanup(self, batch_size=None, older_than=None, start=None):
+        """
+        Remove keys that are no longer valid, one batch at a time.
+
+        Keys created before ``older_than`` are removed too, even if they are
+        still valid. This is a generator yielding a ``(position, count)`` pair
+        for each batch, where ``count`` is the number of keys removed in the
+        batch. Passing the last ``position`` as ``start`` resumes an
+        interrupted clean up.
+        """
+        return iter([])
+
+    def count_invalid(self, older_than=None):
+        """
+        Return the number of keys that ``iter_cleanup`` would remove.
+        """
+        return 0
+
+    def cleanup(self, batch_size=None, sleep=None):
+        """
+        Remove keys that are no longer valid, sleeping ``sleep`` seconds
+        between batches. Returns the number of keys removed.
+        """
+        if sleep is None:
+            sleep = getattr(settings, 'LOGINURL_CLEANUP_SLEEP', 0)
+
+        count = 0
+        for position, removed in self.iter_cleanup(batch_size):
+            count += removed
+            if sleep:
+                time.sleep(sleep)
+
+        return count
+
+class ModelStorage(BaseStorage):
+    """
+    Store the keys in the ``Key`` model.
+    """
+    model = Key
+
+    def create(self, user, usage_left, expires, next):
+        data = Key()
+        data.user = user
+        data.key = create_key(user)
+        data.usage_left = usage_left
+        data.expires = expires
+        data.next = next
+        data.save()
+
+        return data
+
+    def create_many(self, users, usage_left, expires, next):
+        users = list(users)
+        data = [Key(user=user, key=key, usage_left=usage_left,
+                    expires=expires, next=next)
+                for user, key in zip(users, create_keys(users))]
+        Key.objects.bulk_create(data)
+
+        return data
+
+    def consume(self, key):
+        return self.model.objects.consume(key)
+
+    def _next_lookup(self, next):
+        return {'next': next}
+
+    def find(self, user, usage_left, expires, next):
+        """
+        Return the valid key of a user with the same ``usage_left`` and
+        ``next`` that expires closest to ``expires``, or ``None``.
+
+        Keys expiring up to ``settings.LOGINURL_REUSE_MARGIN`` seconds (one
+        day by default) before ``expires`` are accepted, but never keys
+        expiring after it. Keys that have already been used do not have the
+        same ``usage_left``.
+        """
+        queryset = self.model.objects.filter(user=user, usage_left=usage_left,
+                                             **self._next_lookup(next))
+        if expires is None:
+            queryset = queryset.filter(expires__isnull=True)
+        else:
+            queryset = queryset.filter(
+                expires__range=(self._min_expires(expires), expires))
+
+        return queryset.order_by('-expires').first()
+
+    def _min_expires(self, expires):
+        margin = getattr(settings, 'LOGINURL_REUSE_MARGIN', 86400)
+        return max(expires - timedelta(seconds=margin), timezone.now())
+
+    def _is_reusable(self, data, expires):
+        if expires is not None and not (self._min_expires(expires) <=
+                                        data.expires <= expires):
+            return False
+        return self.model.objects.filter(pk=data.pk,
+                                         usage_left=data.usage_left).exists()
+
+    def _reuse_name(self, user, usage_left, expires, next):
+        value = '{}:{}:{}:{}:{}'.format(self.model._meta.db_table, user.pk,
+                                        usage_left, expires is None, next)
+        digest = hashlib.md5(value.encode('utf-8')).hexdigest()
+        return 'loginurl:reuse:{}'.format(digest)
+
+    def get_or_create(self, user, usage_left, expires, next):
+        """
+        Return a valid key of a user matching the arguments, see ``find``, or
+        create one.
+
+        Concurrent calls for the same user wait for each other by locking the
+        row of the user, so they do not create duplicate keys. If
+        ``settings.LOGINURL_REUSE_CACHE_TIMEOUT`` is set, the key found is
+        also kept in the cache named by ``settings.LOGINURL_CACHE`` for that
+        many seconds; a cached key is only returned if it has not been used
+        since.
+        """
+        timeout = getattr(settings, 'LOGINURL_REUSE_CACHE_TIMEOUT', 0)
+        if timeout:
+            cache = get_cache(getattr(settings, 'LOGINURL_CACHE', 'default'))
+            name = self._reuse_name(user, usage_left, expires, next)
+            data = cache.get(name)
+            if data is not None and self._is_reusable(data, expires):
+                return data, False
+
+        using = router.db_for_write(self.model)
+        with transaction.atomic(using=using):
+            list(type(user)._default_manager.using(using).select_for_update()
+                                            .filter(pk=user.pk)
+                                            .values_list('pk', flat=True))
+
+            data = self.find(user, usage_left, expires, next)
+            created = data is None
+            if created:
+                data = self.create(user, usage_left, expires, next)
+
+        if timeout:
+            cache.set(name, data, timeout)
+        return data, created
+
+    def active_keys(self, user):
+        now = timezone.now()
+        return self.model.objects.filter(Q(usage_left__isnull=True) |
+                                         Q(usage_left__gt=0),
+                                         Q(expires__isnull=True) |
+                                         Q(expires__gte=now),
+                                         user=user).order_by('-created')
+
+    def revoke(self, user):
+        return self.active_keys(user).update(usage_left=0)
+
+    def evict(self, user, keep):
+        pks = list(self.active_keys(user).values_list('pk', flat=True)[keep:])
+        if pks:
+            self.model.objects.filter(pk__in=pks).update(usage_left=0)
+
+    def _iter_rows(self, fields, since=None):
+        """
+        Yield the values of ``fields`` of the stored keys, or only the ones
+        created at or after ``since``. The keys are read in batches of
+        ``settings.LOGINURL_BATCH_SIZE`` ordered by primary key, since
+        ``iterator`` still fetches all the rows at once with most databases.
+        """
+        batch_size = getattr(settings, 'LOGINURL_BATCH_SIZE', 1000)
+        queryset = self.model.objects.order_by('pk')
+        if since is not None:
+            queryset = queryset.filter(created__gte=since)
+        queryset = queryset.values_list('pk', *fields)
+
+        last = 0
+        while True:
+            batch = list(queryset.filter(pk__gt=last)[:batch_size])
+            if not batch:
+                break
+            last = batch[-1][0]
+
+            for row in batch:
+                yield row[1:]
+
+            if len(batch) < batch_size:
+                break
+
+    def iter_keys(self, since=None):
+        for key, in self._iter_rows(['key'], since):
+            yield key
+
+    def _invalid(self, older_than=None):
+        queries = [Q(usage_left__lte=0), Q(expires__lt=timezone.now())]
+        if older_than is not None:
+            queries.append(Q(created__lt=older_than))
+        return queries
+
+    def iter_cleanup(self, batch_size=None, older_than=None, start=None):
+        """
+        Remove used up and expired keys in batches.
+
+        Each condition is handled by a separate query, so each can use the
+        index of its column. Keys are deleted by primary key in batches of
+        ``batch_size`` rows, so the table is never locked for long. The
+        position is a ``(condition, primary key)`` pair.
+        """
+        if batch_size is None:
+            batch_size = getattr(settings, 'LOGINURL_CLEANUP_BATCH_SIZE', 1000)
+
+        queries = self._invalid(older_than)
+        first, last = start or (0, 0)
+        for index in range(first, len(queries)):
+            while True:
+                pks = list(self.model.objects
+                                         .filter(queries[index], pk__gt=last)
+                                         .order_by('pk')
+                                         .values_list('pk', flat=True)
+                                         [:batch_size])
+                if not pks:
+                    break
+
+                self.model.objects.filter(pk__in=pks).delete()
+                last = pks[-1]
+                yield (index, last), len(pks)
+
+                if len(pks) < batch_size:
+                    break
+
+            last = 0
+
+    def count_invalid(self, older_than=None):
+        query = reduce(operator.or_, self._invalid(older_than))
+        return self.model.objects.filter(query).count()
+
+class CompactModelStorage(ModelStorage):
+    """
+    Store the keys in the ``CompactKey`` model.
+
+    The tokens are stored as raw bytes, which makes the table and its unique
+    index smaller than the ones of ``Key``, and ``next`` URLs are stored once
+    in ``KeyTarget``. The raw bytes column cannot have a unique index on MySQL,
+    so this storage is meant for PostgreSQL and SQLite. Existing keys can be
+    copied from ``Key`` with the ``loginurl_compact`` command.
+    """
+    model = CompactKey
+
+    def _target(self, next):
+        if next is None:
+            return None
+        return KeyTarget.objects.get_or_create(url=next)[0]
+
+    def _build(self, user, key, usage_left, expires, target):
+        uid, token = split_key(key)
+        return CompactKey(user=user, token=token, usage_left=usage_left,
+                          expires=expires, target=target)
+
+    def _next_lookup(self, next):
+        if next is None:
+            return {'target': None}
+        return {'target__url': next}
+
+    def iter_keys(self, since=None):
+        for uid, token in self._iter_rows(['user', 'token'], since):
+            yield '{}-{}'.format(int_to_base36(uid),
+                                 bytes_to_token(bytes(token)))
+
+    def create(self, user, usage_left, expires, next):
+        data = self._build(user, create_key(user), usage_left, expires,
+                           self._target(next))
+        data.save()
+
+        return data
+
+    def create_many(self, users, usage_left, expires, next):
+        users = list(users)
+        target = self._target(next)
+        data = [self._build(user, key, usage_left, expires, target)
+                for user, key in zip(users, create_keys(users))]
+        CompactKey.objects.bulk_create(data)
+
+        return data
+
+class CacheStorage(BaseStorage):
+    """
+    Store the keys in a Django cache.
+
+    The cache is selected by ``settings.LOGINURL_CACHE`` and is ``default`` by
+    default. Keys are stored with a timeout matching their expiry time, so
+    expired keys disappear without any clean up. The usages of a key are
+    counted using the atomic ``incr`` operation of the cache.
+
+    The keys returned by this storage are unsaved ``Key`` instances. A cache
+    shared by all processes and that does not evict entries prematurely has to
+    be used, otherwise keys may be lost before they expire.
+
+    The keys of a user cannot be listed, so ``active_keys`` and ``evict`` are
+    not supported, and keys cannot be created with
+    ``settings.LOGINURL_MAX_ACTIVE_KEYS_PER_USER`` set. ``revoke`` stores the
+    time of the revocation for ``settings.LOGINURL_REVOKE_TIMEOUT`` seconds
+    (one year by default), and keys created before it are rejected.
+    """
+    prefix = 'loginurl:key:'
+    revoked_prefix = 'loginurl:revoked:'
+
+    @property
+    def cache(self):
+        return get_cache(getattr(settings, 'LOGINURL_CACHE', 'default'))
+
+    def _timeout(self, expires):
+        if expires is None:
+            return None
+        return max(int((expires - timezone.now()).total_seconds()) + 1, 1)
+
+    def _records(self, data):
+        name = self.prefix + data.key
+        record = {
+            'user_id': data.user_id,
+            'created': data.created,
+            'usage_left': data.usage_left,
+            'expires': data.expires,
+            'next': data.next,
+        }
+        records = {name: record}
+        if data.usage_left is not None:
+            records[name + ':used'] = 0
+
+        return records
+
+    def create(self, user, usage_left, expires, next):
+        # Checked before storing the key, as utils.create would fail to evict
+        # the other keys after.
+        if getattr(settings, 'LOGINURL_MAX_ACTIVE_KEYS_PER_USER', None):
+            raise ImproperlyConfigured(
+                'LOGINURL_MAX_ACTIVE_KEYS_PER_USER is not supported by '
+                'CacheStorage.')
+        return self.create_many([user], usage_left, expires, next)[0]
+
+    def create_many(self, users, usage_left, expires, next):
+        users = list(users)
+        now = timezone.now()
+        data = [Key(user=user, key=key, created=now, usage_left=usage_left,
+                    expires=expires, next=next)
+                for user, key in zip(users, create_keys(users))]
+
+        records = {}
+        for item in data:
+            records.update(self._records(item))
+        self.cache.set_many(records, self._timeout(expires))
+
+        return data
+
+    def consume(self, key):
+        cache = self.cache
+        name = self.prefix + key
+        revoked_name = self.revoked_prefix + key.split('-', 1)[0]
+
+        values = cache.get_many([name, revoked_name])
+        record = values.get(name)
+        if record is None:
+            metrics.report(key, metrics.INVALID)
+            return None
+
+        data = Key(key=key, **record)
+        reason = data.invalid_reason()
+        if reason is not None:
+            metrics.report(key, reason)
+            return None
+
+        revoked = values.get(revoked_name)
+        if revoked is not None and data.created <= revoked:
+            metrics.report(key, metrics.EXHAUSTED)
+            return None
+
+        # Keys in the cache are not deleted with their user.
+        try:
+            data.user
+        except User.DoesNotExist:
+            metrics.report(key, metrics.INVALID)
+            return None
+
+        if data.usage_left is not None:
+            try:
+                used = cache.incr(name + ':used')
+            except ValueError:
+                used = None
+
+            if used is None or used > data.usage_left:
+                metrics.report(key, metrics.EXHAUSTED)
+                return None
+            if used == data.usage_left:
+                cache.delete_many([name, name + ':used'])
+            data.usage_left -= used
+
+        return data
+
+    def revoke(self, user):
+        """
+        Make all the keys of a user invalid. Returns ``None``, as the keys
+        revoked are not known.
+        """
+        timeout = getattr(settings, 'LOGINURL_REVOKE_TIMEOUT', 365 * 86400)
+        self.cache.set(self.revoked_prefix + int_to_base36(user.pk),
+                       timezone.now(), timeout)
+
+class PartitionedStorage(BaseStorage):
+    """
+    Store the keys in tables partitioned by expiry time.
+
+    Each key with an expiry time is stored in the table of the period it
+    expires in, e.g. ``loginurl_key_p16000``, and the period is encoded at the
+    end of the key so that it is looked up in the right table. Periods last
+    ``settings.LOGINURL_PARTITION_DAYS`` days, one by default. Once a period
+    is over, its whole table is dropped by the clean up instead of deleting
+    the keys one by one. Keys without an expiry time are stored in the ``Key``
+    model, see ``ModelStorage``.
+
+    The tables are plain tables created on demand, so this storage works with
+    any database. The keys returned by this storage are unsaved ``Key``
+    instances.
+    """
+    prefix = 'loginurl_key_p'
+    table_re = re.compile(r'^loginurl_key_p(\d+)$')
+
+    def __init__(self):
+        self.fallback = ModelStorage()
+        self._tables = set()
+        self._listed = 0
+
+    @property
+    def connection(self):
+        return connections[router.db_for_write(Key)]
+
+    def partition(self, expires):
+        """
+        Return the partition of a key expiring at ``expires``, which is the
+        number of the day, since the epoch, its period ends on.
+        """
+        days = getattr(settings, 'LOGINURL_PARTITION_DAYS', 1)
+        day = _to_timestamp(expires) // 86400
+        return (day // days + 1) * days
+
+    def is_over(self, partition):
+        return partition * 86400 <= _to_timestamp(timezone.now())
+
+    def _table(self, partition):
+        return '{}{}'.format(self.prefix, partition)
+
+    def _list_tables(self):
+        connection = self.connection
+        cursor = connection.cursor()
+        names = connection.introspection.table_names(cursor)
+        self._tables = set(name for name in names
+                           if self.table_re.match(name))
+        self._listed = time.time()
+        return self._tables
+
+    def _has_table(self, table):
+        """
+        Check if a table exists. Unknown tables are looked up by listing the
+        tables at most every ``settings.LOGINURL_PARTITION_LIST_INTERVAL``
+        seconds (1 by default), so keys of made up periods do not each cost
+        a query. Keys used within that time after the first key of a period
+        was created by another process may be rejected.
+        """
+        if table in self._tables:
+            return True
+        interval = getattr(settings, 'LOGINURL_PARTITION_LIST_INTERVAL', 1)
+        if self._listed + interval > time.time():
+            return False
+        return table in self._list_tables()
+
+    def _create_table(self, partition):
+        table = self._table(partition)
+        if table in self._tables:
+            return
+
+        connection = self.connection
+        types = connection.creation.data_types
+        qn = connection.ops.quote_name
+        # MySQL has no CREATE INDEX IF NOT EXISTS, the index is created with
+        # the table instead.
+        index = ''
+        if connection.vendor == 'mysql':
+            index = ', INDEX ({})'.format(qn('user_id'))
+        cursor = connection.cursor()
+        cursor.execute(
+            'CREATE TABLE IF NOT EXISTS {} ('
+            '{} {} NOT NULL PRIMARY KEY, {} {} NOT NULL, {} {} NOT NULL, '
+            '{} {} NULL, {} {} NOT NULL, {} {} NULL{})'.format(
+                qn(table),
+                qn('key'), types['CharField'] % {'max_length': 64},
+                qn('user_id'), types['IntegerField'],
+                qn('created'), types['DateTimeField'],
+                qn('usage_left'), types['IntegerField'],
+                qn('expires'), types['DateTimeField'],
+                qn('next'), types['CharField'] % {'max_length': 200},
+                index))
+        if not index:
+            cursor.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+                qn(table + '_user_id'), qn(table), qn('user_id')))
+        self._tables.add(table)
+
+    def _to_python(self, value):
+        # Backends without time zone support return naive datetimes in UTC.
+        if isinstance(value, six.string_types):
+            value = parse_datetime(value)
+        if value is not None and settings.USE_TZ and timezone.is_naive(value):
+            value = timezone.make_aware(value, timezone.utc)
+        return value
+
+    def _key_partition(self, key):
+        parts = key.split('-')
+        if len(parts) != 3:
+            return None
+        try:
+            return base36_to_int(parts[2])
+        except ValueError:
+            return None
+
+    def create(self, user, usage_left, expires, next):
+        return self.create_many([user], usage_left, expires, next)[0]
+
+    def create_many(self, users, usage_left, expires, next):
+        if expires is None:
+            return self.fallback.create_many(users, usage_left, expires, next)
+
+        partition = self.partition(expires)
+        suffix = int_to_base36(partition)
+        now = timezone.now()
+        users = list(users)
+        data = [Key(user=user, key='{}-{}'.format(key, suffix), created=now,
+                    usage_left=usage_left, expires=expires, next=next)
+                for user, key in zip(users, create_keys(users))]
+
+        self._create_table(partition)
+        connection = self.connection
+        qn = connection.ops.quote_name
+        to_db = connection.ops.value_to_db_datetime
+        connection.cursor().executemany(
+            'INSERT INTO {} ({}, {}, {}, {}, {}, {}) '
+            'VALUES (%s, %s, %s, %s, %s, %s)'.format(
+                qn(self._table(partition)), qn('key'), qn('user_id'),
+                qn('created'), qn('usage_left'), qn('expires'), qn('next')),
+            [(item.key, item.user_id, to_db(item.created), item.usage_left,
+              to_db(item.expires), item.next)
+             for item in data])
+
+        return data
+
+    def consume(self, key):
+        partition = self._key_partition(key)
+        if partition is None:
+            return self.fallback.consume(key)
+
+        if self.is_over(partition):
+            metrics.report(key, metrics.EXPIRED)
+            return None
+
+        table = self._table(partition)
+        if not self._has_table(table):
+            metrics.report(key, metrics.INVALID)
+            return None
+
+        connection = self.connection
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.execute(
+            'SELECT {}, {}, {}, {}, {} FROM {} WHERE {} = %s'.format(
+                qn('user_id'), qn('created'), qn('usage_left'), qn('expires'),
+                qn('next'), qn(table), qn('key')),
+            [key])
+        row = cursor.fetchone()
+        if row is None:
+            metrics.report(key, metrics.INVALID)
+            return None
+
+        user_id, created, usage_left, expires, next = row
+        data = Key(key=key, user_id=user_id, created=self._to_python(created),
+                   usage_left=usage_left, expires=self._to_python(expires),
+                   next=next)
+        reason = data.invalid_reason()
+        if reason is not None:
+            metrics.report(key, reason)
+            return None
+
+        if data.usage_left is not None:
+            cursor.execute(
+                'UPDATE {} SET {} = {} - 1 WHERE {} = %s AND {} > 0'.format(
+                    qn(table), qn('usage_left'), qn('usage_left'), qn('key'),
+                    qn('usage_left')),
+                [key])
+            if not cursor.rowcount:
+                metrics.report(key, metrics.EXHAUSTED)
+                return None
+            data.usage_left -= 1
+
+        return data
+
+    def _partitions(self):
+        return sorted(int(self.table_re.match(table).group(1))
+                      for table in self._list_tables())
+
+    def _expired_partitions(self):
+        return [partition for partition in self._partitions()
+                if self.is_over(partition)]
+
+    def _live_partitions(self):
+        return [partition for partition in self._partitions()
+                if not self.is_over(partition)]
+
+    def active_keys(self, user):
+        """
+        Return the valid keys of a user, newest first, as a list.
+        """
+        keys = list(self.fallback.active_keys(user))
+
+        connection = self.connection
+        qn = connection.ops.quote_name
+        now = connection.ops.value_to_db_datetime(timezone.now())
+        cursor = connection.cursor()
+        for partition in self._live_partitions():
+            cursor.execute(
+                'SELECT {}, {}, {}, {}, {} FROM {} WHERE {} = %s AND '
+                '({} IS NULL OR {} > 0) AND {} >= %s'.format(
+                    qn('key'), qn('created'), qn('usage_left'),
+                    qn('expires'), qn('next'), qn(self._table(partition)),
+                    qn('user_id'), qn('usage_left'), qn('usage_left'),
+                    qn('expires')),
+                [user.pk, now])
+            keys.extend(Key(key=key, user=user,
+                            created=self._to_python(created),
+                            usage_left=usage_left,
+                            expires=self._to_python(expires), next=next)
+                        for key, created, usage_left, expires, next
+                        in cursor.fetchall())
+
+        keys.sort(key=lambda data: data.created, reverse=True)
+        return keys
+
+    def revoke(self, user):
+        count = self.fallback.revoke(user)
+
+        connection = self.connection
+        qn = connection.ops.quote_name
+        now = connection.ops.value_to_db_datetime(timezone.now())
+        cursor = connection.cursor()
+        for partition in self._live_partitions():
+            cursor.execute(
+                'UPDATE {} SET {} = 0 WHERE {} = %s AND '
+                '({} IS NULL OR {} > 0) AND {} >= %s'.format(
+                    qn(self._table(partition)), qn('usage_left'),
+                    qn('user_id'), qn('usage_left'), qn('usage_left'),
+                    qn('expires')),
+                [user.pk, now])
+            count += cursor.rowcount
+        return count
+
+    def evict(self, user, keep):
+        tables = {}
+        for data in self.active_keys(user)[keep:]:
+            partition = self._key_partition(data.key)
+            tables.setdefault(partition, []).append(data.key)
+
+        stored = tables.pop(None, None)
+        if stored:
+            self.fallback.model.objects.filter(key__in=stored) \
+                                       .update(usage_left=0)
+
+        connection = self.connection
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        for partition, keys in tables.items():
+            cursor.execute(
+                'UPDATE {} SET {} = 0 WHERE {} IN ({})'.format(
+                    qn(self._table(partition)), qn('usage_left'), qn('key'),
+                    ', '.join(['%s'] * len(keys))),
+                keys)
+
+    def iter_cleanup(self, batch_size=None, older_than=None, start=None):
+        """
+        Drop the tables of the periods that are over, after removing the keys
+        without an expiry time from the ``Key`` model.
+
+        Keys in the tables of the periods that are not over are left alone,
+        even if they are used up or older than ``older_than``. The position of
+        a dropped table is a ``('partition', partition)`` pair. The tables are
+        not counted before being dropped, their number of keys is the one
+        estimated by the database, or 0 if no estimate is available.
+        """
+        if start is None or start[0] != 'partition':
+            for position, count in self.fallback.iter_cleanup(
+                    batch_size, older_than, start):
+                yield position, count
+
+        for partition in self._expired_partitions():
+            count = self._estimate(partition)
+            table = self._table(partition)
+            self.connection.cursor().execute('DROP TABLE {}'.format(
+                self.connection.ops.quote_name(table)))
+            self._tables.discard(table)
+            yield ('partition', partition), count
+
+    def _estimate(self, partition):
+        return estimate_rows(self.connection, self._table(partition)) or 0
+
+    def count_invalid(self, older_than=None):
+        """
+        Count the keys removed by the clean up. The keys of the tables of the
+        periods that are over are estimated, see ``iter_cleanup``.
+        """
+        return (self.fallback.count_invalid(older_than) +
+                sum(self._estimate(partition)
+                    for partition in self._expired_partitions()))
@@ -1,3 +1,4 @@
+import json
 import unittest
 from datetime import timedelta
 
@@ -8,10 +9,25 @@ from django.utils import timezone
 from django.utils.http import int_to_base36, base36_to_int
 from django.http import HttpResponse, HttpResponseRedirect, HttpResponseGone
 from django.conf import settings
+from django.contrib.admin.sites import site
 from django.core import management
-
-from loginurl.models import Key
-from loginurl import utils, backends, views
+from django.core.cache import get_cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DatabaseError
+from django.test.utils import override_settings
+from django.utils.six import StringIO, BytesIO
+from django.test.client import RequestFactory
+from django.contrib.sessions.middleware import SessionMiddleware
+
+from loginurl.models import Key, CompactKey, KeyEvent
+from loginurl.cache import LRUCache, StripedCounter
+from loginurl.storage import get_storage
+from loginurl import utils, backends, views, throttling, metrics, usage, \
+     bloom, export, audit
+from loginurl.decorators import key_required
+from loginurl.middleware import LoginUrlMiddleware
+from loginurl.admin import KeyAdmin, LargeTablePaginator, \
+     LargeTableChangeList, ValidityListFilter
 
 class BaseTestCase(unittest.TestCase):
     def setUp(self):
@@ -48,6 +64,235 @@ class CreateKeyTestCase(BaseTestCase):
         data = utils.create(self.user, next=next)
         self.assertEqual(data.next, next)
 
+class ReuseKeyTestCase(BaseTestCase):
+    def setUp(self):
+        get_cache('default').clear()
+        BaseTestCase.setUp(self)
+
+    def testReuse(self):
+        oneweek = timezone.now() + timedelta(days=7)
+        data = utils.create(self.user, expires=oneweek, next='/next/page/')
+
+        later = oneweek + timedelta(hours=1)
+        reused = utils.create(self.user, expires=later, next='/next/page/',
+                              reuse=True)
+        self.assertEqual(reused.key, data.key)
+        self.assertEqual(Key.objects.count(), 1)
+
+    def testExpiresLater(self):
+        nextyear = timezone.now() + timedelta(days=365)
+        longlived = utils.create(self.user, expires=nextyear)
+
+        onehour = timezone.now() + timedelta(hours=1)
+        data = utils.create(self.user, expires=onehour, reuse=True)
+        self.assertNotEqual(data.key, longlived.key)
+        self.assertEqual(data.expires, onehour)
+
+        with override_settings(LOGINURL_REUSE_CACHE_TIMEOUT=60):
+            utils.create(self.user, expires=nextyear, reuse=True)
+            self.assertEqual(utils.create(self.user, expires=onehour,
+                                          reuse=True).key, data.key)
+
+    def testDifferent(self):
+        oneweek = timezone.now() + timedelta(days=7)
+        utils.create(self.user, expires=oneweek, next='/next/page/')
+
+        keys = [
+            utils.create(self.user, expires=oneweek, next='/other/',
+                         reuse=True),
+            utils.create(self.user, usage_left=2, expires=oneweek,
+                         next='/next/page/', reuse=True),
+            utils.create(self.user, expires=oneweek + timedelta(days=2),
+                         next='/next/page/', reuse=True),
+            utils.create(self.user, next='/next/page/', reuse=True),
+        ]
+        self.assertEqual(len(set(data.key for data in keys)), 4)
+        self.assertEqual(Key.objects.count(), 5)
+
+    def testUsed(self):
+        data = utils.create(self.user, reuse=True)
+        self.assertEqual(utils.create(self.user, reuse=True).key, data.key)
+
+        Key.objects.consume(data.key)
+        self.assertNotEqual(utils.create(self.user, reuse=True).key, data.key)
+
+    def testCache(self):
+        with override_settings(LOGINURL_REUSE_CACHE_TIMEOUT=60):
+            data = utils.create(self.user, reuse=True)
+
+            with patch.object(get_storage(), 'find') as find:
+                self.assertEqual(utils.create(self.user, reuse=True).key,
+                                 data.key)
+                self.assertFalse(find.called)
+
+            Key.objects.consume(data.key)
+            self.assertNotEqual(utils.create(self.user, reuse=True).key,
+                                data.key)
+
+    def testCompact(self):
+        with override_settings(
+                LOGINURL_STORAGE='loginurl.storage.CompactModelStorage'):
+            data = utils.create(self.user, next='/next/page/', reuse=True)
+            self.assertEqual(utils.create(self.user, next='/next/page/',
+                                          reuse=True).key, data.key)
+            self.assertNotEqual(utils.create(self.user, reuse=True).key,
+                                data.key)
+
+class UserKeysTestCase(BaseTestCase):
+    def setUp(self):
+        BaseTestCase.setUp(self)
+        self.other = User.objects.create_user('other')
+
+        now = timezone.now()
+        self.keys = []
+        for i in range(3):
+            data = utils.create(self.user)
+            Key.objects.filter(pk=data.pk).update(
+                created=now - timedelta(days=3 - i))
+            self.keys.append(data)
+        utils.create(self.user, usage_left=0)
+        utils.create(self.other)
+
+    def testActiveKeys(self):
+        keys = [data.key for data in utils.active_keys(self.user)]
+        self.assertEqual(keys, [data.key for data in reversed(self.keys)])
+
+    def testRevoke(self):
+        self.assertEqual(utils.revoke(self.user), 3)
+        self.assertEqual(list(utils.active_keys(self.user)), [])
+        self.assertEqual(len(utils.active_keys(self.other)), 1)
+
+    def testMaxActiveKeys(self):
+        with override_settings(LOGINURL_MAX_ACTIVE_KEYS_PER_USER=2):
+            data = utils.create(self.user)
+
+        keys = [item.key for item in utils.active_keys(self.user)]
+        self.assertEqual(keys, [data.key, self.keys[2].key])
+        self.assertEqual(len(utils.active_keys(self.other)), 1)
+
+class TokenPoolTestCase(BaseTestCase):
+    def testDisabled(self):
+        self.assertEqual(utils.get_token_pool(), None)
+
+    def testCreate(self):
+        with override_settings(LOGINURL_TOKEN_POOL_SIZE=10):
+            pool = utils.get_token_pool()
+            pool.refill()
+            data = utils.create(self.user)
+
+        self.assertTrue(utils.is_valid_format(data.key))
+        self.assertEqual(pool.hits, 1)
+        self.assertEqual(pool.misses, 0)
+
+    def testRefill(self):
+        pool = utils.TokenPool(10, 5)
+        pool.refill()
+        self.assertEqual(pool.stats()['available'], 10)
+
+        with patch.object(pool, '_start_refill') as refill:
+            tokens = set(pool.get() for i in range(6))
+            self.assertEqual(len(tokens), 6)
+            self.assertTrue(refill.called)
+
+    def testEmpty(self):
+        pool = utils.TokenPool(10, 0)
+        pool.get()
+
+        self.assertEqual(pool.stats(), {'available': 0, 'hits': 0,
+                                        'misses': 1})
+
+    def testFork(self):
+        pool = utils.TokenPool(10, 0)
+        pool.refill()
+
+        with patch('os.getpid', return_value=-1):
+            pool.get()
+        self.assertEqual(pool.stats()['misses'], 1)
+
+class RandomTokenTestCase(BaseTestCase):
+    def testTokens(self):
+        tokens = utils.random_tokens(100)
+
+        self.assertEqual(len(set(tokens)), 100)
+        for token in tokens:
+            key = '{}-{}'.format(int_to_base36(self.user.id), token)
+            self.assertTrue(utils.is_valid_format(key))
+
+    def testChunks(self):
+        with override_settings(LOGINURL_TOKEN_CHUNK_SIZE=3):
+            with patch.object(utils, 'random_tokens',
+                              wraps=utils.random_tokens) as random_tokens:
+                utils._tokens.clear()
+                tokens = set(utils._create_token() for i in range(6))
+
+        self.assertEqual(len(tokens), 6)
+        self.assertEqual(random_tokens.call_count, 2)
+
+    def testFork(self):
+        utils._create_token()
+        with patch('os.getpid', return_value=-1):
+            with patch.object(utils, 'random_tokens',
+                              wraps=utils.random_tokens) as random_tokens:
+                utils._create_token()
+        self.assertTrue(random_tokens.called)
+
+    def testCreateKeys(self):
+        users = [self.user, User.objects.create_user('other')]
+        keys = utils.create_keys(users)
+
+        self.assertEqual([base36_to_int(key.split('-')[0]) for key in keys],
+                         [user.id for user in users])
+        self.assertTrue(all(utils.is_valid_format(key) for key in keys))
+
+class CreateManyTestCase(BaseTestCase):
+    def setUp(self):
+        BaseTestCase.setUp(self)
+        self.users = [self.user]
+        for i in range(4):
+            self.users.append(User.objects.create_user('test{}'.format(i)))
+
+    def testDefault(self):
+        data = list(utils.create_many(self.users, batch_size=2))
+        self.assertEqual(len(data), 5)
+
+        for user, key in zip(self.users, data):
+            datadb = Key.objects.get(key=key.key)
+            self.assertEqual(datadb.user, user)
+            self.assertEqual(datadb.usage_left, 1)
+            self.assertEqual(datadb.expires, None)
+            self.assertEqual(datadb.next, None)
+
+    def testQuerySet(self):
+        oneweek = timezone.now() + timedelta(days=7)
+        data = list(utils.create_many(User.objects.all(), usage_left=10,
+                                      expires=oneweek, next='/next/page/'))
+        self.assertEqual(len(data), 5)
+        self.assertEqual(Key.objects.filter(usage_left=10, expires=oneweek,
+                                            next='/next/page/').count(), 5)
+
+    def testQuerySetBatches(self):
+        users = User.objects.filter(pk__in=[user.pk for user in self.users])
+        with patch.object(get_storage(), 'create_many',
+                          side_effect=lambda users, *args: []):
+            with metrics.QueryCounter() as queries:
+                list(utils.create_many(users.order_by('-pk'), batch_size=2))
+        # Three batches of users.
+        self.assertEqual(queries.count, 3)
+
+        data = list(utils.create_many(users.order_by('-pk'), batch_size=2))
+        self.assertEqual([key.user for key in data], self.users)
+
+        data = list(utils.create_many(users.order_by('pk')[1:3],
+                                      batch_size=2))
+        self.assertEqual([key.user for key in data], self.users[1:3])
+
+    def testLazy(self):
+        data = utils.create_many(self.users, batch_size=2)
+        self.assertEqual(Key.objects.count(), 0)
+
+        next(data)
+        self.assertEqual(Key.objects.count(), 2)
+
 class CleanUpTestCase(BaseTestCase):
     def testPositive(self):
         data = utils.create(self.user, usage_left=1)
@@ -93,6 +338,32 @@ class CleanUpTestCase(BaseTestCase):
         utils.cleanup()
         self.assertEqual(len(Key.objects.all()), 1)
 
+    def testBatches(self):
+        oneweekago = timezone.now() - timedelta(days=7)
+        for i in range(5):
+            utils.create(self.user, usage_left=0)
+            utils.create(self.user, expires=oneweekago)
+        utils.create(self.user)
+
+        self.assertEqual(utils.cleanup(batch_size=2), 10)
+        self.assertEqual(len(Key.objects.all()), 1)
+
+class AmortizedCleanUpTestCase(BaseTestCase):
+    def setUp(self):
+        BaseTestCase.setUp(self)
+        for i in range(3):
+            utils.create(self.user, usage_left=0)
+
+    def testDisabled(self):
+        utils.create(self.user)
+        self.assertEqual(len(Key.objects.all()), 4)
+
+    def testCreate(self):
+        with override_settings(LOGINURL_CLEANUP_PROBABILITY=1,
+                               LOGINURL_CLEANUP_AMORTIZED_BATCH_SIZE=2):
+            utils.create(self.user)
+        self.assertEqual(len(Key.objects.all()), 2)
+
 class ModelCheckValidTestCase(BaseTestCase):
     def testPositive(self):
         oneweek = timezone.now() + timedelta(days=7)
@@ -174,6 +445,169 @@ class ModelUpdateUsageTestCase(BaseTestCase):
         datadb = Key.objects.get(key=data.key)
         self.assertEqual(datadb.usage_left, -100)
 
+    def testStale(self):
+        data = Key.objects.create(user=self.user, usage_left=1)
+        stale = Key.objects.get(key=data.key)
+
+        self.assertTrue(data.update_usage())
+        self.assertFalse(stale.update_usage())
+
+        datadb = Key.objects.get(key=data.key)
+        self.assertEqual(datadb.usage_left, 0)
+
+class WriteBehindUsageTestCase(BaseTestCase):
+    def setUp(self):
+        get_cache('default').clear()
+        usage._local = StripedCounter()
+        usage.flush()
+        self.settings = override_settings(LOGINURL_USAGE_WRITE_BEHIND='cache',
+                                          LOGINURL_USAGE_WRITE_BEHIND_MIN=3,
+                                          LOGINURL_USAGE_FLUSH_INTERVAL=0)
+        self.settings.enable()
+        BaseTestCase.setUp(self)
+
+    def tearDown(self):
+        self.settings.disable()
+
+    def testDeferred(self):
+        data = Key.objects.create(user=self.user, usage_left=5)
+        stale = Key.objects.get(pk=data.pk)
+
+        self.assertTrue(data.update_usage())
+        self.assertTrue(stale.update_usage())
+        self.assertEqual(stale.usage_left, 3)
+        self.assertEqual(Key.objects.get(pk=data.pk).usage_left, 5)
+
+        self.assertEqual(usage.flush(), 1)
+        self.assertEqual(Key.objects.get(pk=data.pk).usage_left, 3)
+
+    def testLimit(self):
+        data = Key.objects.create(user=self.user, usage_left=3)
+
+        for i in range(3):
+            self.assertTrue(Key.objects.get(pk=data.pk).update_usage())
+        self.assertFalse(Key.objects.get(pk=data.pk).update_usage())
+
+        usage.flush()
+        self.assertEqual(Key.objects.get(pk=data.pk).usage_left, 0)
+
+    def testFewUsages(self):
+        data = Key.objects.create(user=self.user, usage_left=2)
+
+        self.assertTrue(data.update_usage())
+        self.assertEqual(Key.objects.get(pk=data.pk).usage_left, 1)
+
+    def testRevoked(self):
+        data = Key.objects.create(user=self.user, usage_left=5)
+        self.assertTrue(data.update_usage())
+        utils.revoke(self.user)
+
+        usage.flush()
+        self.assertEqual(Key.objects.get(pk=data.pk).usage_left, 0)
+
+    def testLocal(self):
+        data = Key.objects.create(user=self.user, usage_left=3)
+
+        with override_settings(LOGINURL_USAGE_WRITE_BEHIND='local'):
+            for i in range(3):
+                self.assertTrue(Key.objects.get(pk=data.pk).update_usage())
+            self.assertFalse(Key.objects.get(pk=data.pk).update_usage())
+            usage.flush()
+
+        name = 'loginurl:usage:loginurl_key:{}:used'.format(data.pk)
+        self.assertEqual(get_cache('default').get(name), None)
+        self.assertEqual(usage._local.get_many([name]), {name: 0})
+        self.assertEqual(Key.objects.get(pk=data.pk).usage_left, 0)
+
+    def testLocalProcesses(self):
+        data = Key.objects.create(user=self.user, usage_left=4)
+        first = usage._local
+
+        with override_settings(LOGINURL_USAGE_WRITE_BEHIND='local'):
+            for i in range(2):
+                self.assertTrue(Key.objects.get(pk=data.pk).update_usage())
+            usage.flush()
+
+            # Another process.
+            usage._local = StripedCounter()
+            for i in range(2):
+                self.assertTrue(Key.objects.get(pk=data.pk).update_usage())
+            self.assertFalse(Key.objects.get(pk=data.pk).update_usage())
+            usage.flush()
+
+            usage._local = first
+            usage.flush()
+            self.assertFalse(Key.objects.get(pk=data.pk).update_usage())
+
+        self.assertEqual(Key.objects.get(pk=data.pk).usage_left, 0)
+
+    def testFlushError(self):
+        data = Key.objects.create(user=self.user, usage_left=5)
+        self.assertTrue(data.update_usage())
+
+        with patch.object(Key._default_manager, 'filter',
+                          side_effect=DatabaseError):
+            self.assertRaises(DatabaseError, usage.flush)
+        self.assertEqual(usage.flush(), 1)
+        self.assertEqual(Key.objects.get(pk=data.pk).usage_left, 4)
+
+    def testFlusherError(self):
+        with patch('loginurl.usage.time.sleep'), \
+             patch.object(usage.logger, 'exception') as exception:
+            with patch.object(usage, 'flush',
+                              side_effect=[DatabaseError, SystemExit]) as flush:
+                self.assertRaises(SystemExit, usage._run, 1)
+        self.assertEqual(flush.call_count, 2)
+        self.assertEqual(exception.call_count, 1)
+
+class StripedCounterTestCase(unittest.TestCase):
+    def testCounter(self):
+        counter = StripedCounter(stripes=2)
+
+        self.assertTrue(counter.add('a', 1))
+        self.assertFalse(counter.add('a', 5))
+        self.assertEqual(counter.incr('a'), 2)
+        self.assertRaises(ValueError, counter.incr, 'b')
+        self.assertEqual(counter.get_many(['a', 'b']), {'a': 2})
+
+    def testTimeout(self):
+        counter = StripedCounter()
+        counter.add('a', 1, timeout=-1)
+
+        self.assertRaises(ValueError, counter.incr, 'a')
+        self.assertTrue(counter.add('a', 2))
+        counter.add('b', 1, timeout=-1)
+        counter.prune()
+        self.assertEqual(len(counter), 1)
+
+class ModelConsumeTestCase(BaseTestCase):
+    def testDefault(self):
+        data = utils.create(self.user)
+
+        res = Key.objects.consume(data.key)
+        self.assertEqual(res.user, self.user)
+        self.assertEqual(res.usage_left, 0)
+
+        self.assertEqual(Key.objects.consume(data.key), None)
+
+    def testUnknown(self):
+        self.assertEqual(Key.objects.consume('1-unknown'), None)
+
+    def testExpired(self):
+        oneweekago = timezone.now() - timedelta(days=7)
+        data = utils.create(self.user, expires=oneweekago)
+
+        self.assertEqual(Key.objects.consume(data.key), None)
+
+        datadb = Key.objects.get(key=data.key)
+        self.assertEqual(datadb.usage_left, 1)
+
+    def testAlwaysValid(self):
+        data = utils.create(self.user, usage_left=None)
+
+        self.assertEqual(Key.objects.consume(data.key).user, self.user)
+        self.assertEqual(Key.objects.consume(data.key).user, self.user)
+
 class BackendTestCase(BaseTestCase):
     def setUp(self):
         self.backend = backends.LoginUrlBackend()
@@ -184,6 +618,10 @@ class BackendTestCase(BaseTestCase):
 
         res = self.backend.authenticate(data.key)
         self.assertEqual(res, self.user)
+        self.assertEqual(res.loginurl_key.key, data.key)
+
+        res = self.backend.authenticate(data.key)
+        self.assertEqual(res, None)
 
     def testInvalidKey(self):
         data = utils.create(self.user)
@@ -204,9 +642,607 @@ class BackendTestCase(BaseTestCase):
         user = self.backend.get_user(self.user.id)
         self.assertEqual(user, self.user)
 
+class FastRejectTestCase(BaseTestCase):
+    def setUp(self):
+        get_cache('default').clear()
+        self.backend = backends.LoginUrlBackend()
+        BaseTestCase.setUp(self)
+
+    def testFormat(self):
+        data = utils.create(self.user)
+        self.assertTrue(utils.is_valid_format(data.key))
+        self.assertFalse(utils.is_valid_format('1-invalid'))
+        self.assertFalse(utils.is_valid_format(data.key.upper()))
+
+        with patch.object(Key.objects, 'consume') as consume:
+            self.assertEqual(self.backend.authenticate('1-invalid'), None)
+            self.assertFalse(consume.called)
+
+    def testNegativeCache(self):
+        data = utils.create(self.user)
+
+        with override_settings(LOGINURL_NEGATIVE_CACHE_TIMEOUT=60):
+            self.assertEqual(self.backend.authenticate(data.key), self.user)
+            self.assertEqual(self.backend.authenticate(data.key), None)
+            self.assertTrue(throttling.is_known_invalid(data.key))
+
+            with patch.object(Key.objects, 'consume') as consume:
+                self.assertEqual(self.backend.authenticate(data.key), None)
+                self.assertFalse(consume.called)
+
+    def testRateLimit(self):
+        data = utils.create(self.user)
+        factory = RequestFactory()
+
+        with override_settings(LOGINURL_RATE_LIMIT=(2, 60)):
+            for i in range(2):
+                req = factory.get('/', REMOTE_ADDR='10.0.0.1')
+                res = views.login(req, 'zz-{}'.format('0' * 32))
+                self.assertTrue(isinstance(res, HttpResponseRedirect))
+
+            req = factory.get('/', REMOTE_ADDR='10.0.0.1')
+            res = views.login(req, data.key)
+            self.assertEqual(res.status_code, 429)
+
+            self.assertFalse(throttling.is_throttled(
+                factory.get('/', REMOTE_ADDR='10.0.0.2'), data.key))
+
+    def testRateLimitPerUser(self):
+        data = utils.create(self.user)
+        uid = int_to_base36(self.user.id)
+        factory = RequestFactory()
+
+        with override_settings(LOGINURL_RATE_LIMIT=(2, 60)):
+            for i in range(3):
+                req = factory.get('/', REMOTE_ADDR='10.0.1.{}'.format(i))
+                views.login(req, '{}-{}'.format(uid, '0' * 32))
+            self.assertFalse(throttling.is_throttled(
+                factory.get('/', REMOTE_ADDR='10.0.2.1'), data.key))
+
+            with override_settings(LOGINURL_RATE_LIMIT_PER_USER=True):
+                for i in range(3):
+                    req = factory.get('/', REMOTE_ADDR='10.0.3.{}'.format(i))
+                    views.login(req, '{}-x'.format(uid))
+                self.assertFalse(throttling.is_throttled(
+                    factory.get('/', REMOTE_ADDR='10.0.4.1'), data.key))
+
+                for i in range(2):
+                    req = factory.get('/', REMOTE_ADDR='10.0.5.{}'.format(i))
+                    views.login(req, '{}-{}'.format(uid, '1' * 32))
+                self.assertTrue(throttling.is_throttled(
+                    factory.get('/', REMOTE_ADDR='10.0.6.1'), data.key))
+
+class BloomFilterTestCase(BaseTestCase):
+    def setUp(self):
+        self.backend = backends.LoginUrlBackend()
+        self.settings = override_settings(LOGINURL_BLOOM_CAPACITY=1000,
+                                          LOGINURL_BLOOM_SYNC_INTERVAL=3600)
+        self.settings.enable()
+        BaseTestCase.setUp(self)
+        self.existing = utils.create(self.user)
+        bloom.rebuild()
+
+    def tearDown(self):
+        bloom._filter = None
+        self.settings.disable()
+
+    def testFilter(self):
+        data = bloom.BloomFilter(100, 0.01)
+        for i in range(100):
+            data.add(str(i))
+
+        for i in range(100):
+            self.assertTrue(str(i) in data)
+        self.assertTrue(data.estimated_error_rate() < 0.02)
+        self.assertEqual(data.stats()['count'], 100)
+
+    def testUnknown(self):
+        key = '{}-{}'.format(int_to_base36(self.user.id), '0' * 32)
+
+        with patch.object(Key.objects, 'consume') as consume:
+            self.assertEqual(self.backend.authenticate(key), None)
+            self.assertFalse(consume.called)
+
+    def testCreated(self):
+        single = utils.create(self.user)
+        many = list(utils.create_many([self.user] * 2))
+
+        for data in [self.existing, single] + many:
+            self.assertEqual(self.backend.authenticate(data.key), self.user)
+
+    def testOtherProcess(self):
+        data = Key(user=self.user, key=utils.create_key(self.user))
+        Key.objects.bulk_create([data])
+
+        self.assertEqual(self.backend.authenticate(data.key), None)
+        with override_settings(LOGINURL_BLOOM_SYNC_INTERVAL=0):
+            self.assertEqual(self.backend.authenticate(data.key), self.user)
+
+    def testBatches(self):
+        keys = [data.key for data in utils.create_many([self.user] * 4)]
+
+        with override_settings(LOGINURL_BATCH_SIZE=2):
+            self.assertEqual(sorted(get_storage().iter_keys()),
+                             sorted(keys + [self.existing.key]))
+
+    def testLateCommit(self):
+        # A key with a lower primary key committed after a key with a greater
+        # one was looked up.
+        newer = Key(pk=self.existing.pk + 3, user=self.user,
+                    key=utils.create_key(self.user))
+        late = Key(pk=self.existing.pk + 2, user=self.user,
+                   key=utils.create_key(self.user))
+
+        with override_settings(LOGINURL_BLOOM_SYNC_INTERVAL=0):
+            Key.objects.bulk_create([newer])
+            self.assertEqual(self.backend.authenticate(newer.key), self.user)
+            Key.objects.bulk_create([late])
+            self.assertEqual(self.backend.authenticate(late.key), self.user)
+
+    def testNotBuilt(self):
+        bloom._filter = None
+        bloom._building = True
+        data = Key(user=self.user, key=utils.create_key(self.user))
+        Key.objects.bulk_create([data])
+
+        self.assertEqual(bloom.stats(), None)
+        self.assertEqual(self.backend.authenticate(data.key), self.user)
+        bloom._building = False
+
+class UserCacheTestCase(BaseTestCase):
+    def setUp(self):
+        self.backend = backends.LoginUrlBackend()
+        self.settings = override_settings(LOGINURL_USER_CACHE_SIZE=10)
+        self.settings.enable()
+        BaseTestCase.setUp(self)
+        backends.get_user_cache().clear()
+
+    def tearDown(self):
+        self.settings.disable()
+
+    def testCached(self):
+        cache = backends.get_user_cache()
+
+        self.assertEqual(self.backend.get_user(self.user.id), self.user)
+        self.assertEqual(cache.misses, 1)
+
+        with patch.object(User.objects, 'get') as get:
+            user = self.backend.get_user(self.user.id)
+            self.assertFalse(get.called)
+        self.assertEqual(user, self.user)
+        self.assertEqual(cache.hits, 1)
+
+    def testInvalidate(self):
+        self.backend.get_user(self.user.id)
+
+        self.user.first_name = 'Changed'
+        self.user.save()
+
+        user = self.backend.get_user(self.user.id)
+        self.assertEqual(user.first_name, 'Changed')
+
+    def testDeleted(self):
+        self.backend.get_user(self.user.id)
+        self.user.delete()
+
+        self.assertEqual(self.backend.get_user(self.user.id), None)
+
+    def testExpired(self):
+        cache = LRUCache(10, ttl=-1)
+        cache.set(1, 'user')
+        self.assertEqual(cache.get(1), None)
+
+    def testSize(self):
+        cache = LRUCache(2)
+        for i in range(3):
+            cache.set(i, i)
+        self.assertEqual(cache.get(0), None)
+        self.assertEqual(cache.get(2), 2)
+
+class SignedKeyTestCase(BaseTestCase):
+    def setUp(self):
+        self.backend = backends.LoginUrlBackend()
+        BaseTestCase.setUp(self)
+
+    def testDefault(self):
+        key = utils.create_signed(self.user, next='/next/page/')
+        self.assertTrue(utils.is_signed(key))
+        self.assertEqual(Key.objects.count(), 0)
+
+        res = self.backend.authenticate(key)
+        self.assertEqual(res, self.user)
+        self.assertEqual(res.loginurl_key.next, '/next/page/')
+        self.assertEqual(res.loginurl_key.usage_left, 0)
+
+        res = self.backend.authenticate(key)
+        self.assertEqual(res, None)
+
+    def testTenTimes(self):
+        key = utils.create_signed(self.user, usage_left=10)
+
+        for i in range(10):
+            self.assertEqual(self.backend.authenticate(key), self.user)
+        self.assertEqual(self.backend.authenticate(key), None)
+
+    def testAlwaysValid(self):
+        key = utils.create_signed(self.user, usage_left=None)
+
+        self.assertEqual(self.backend.authenticate(key), self.user)
+        self.assertEqual(self.backend.authenticate(key), self.user)
+
+    def testDeletedUser(self):
+        keys = [utils.create_signed(self.user),
+                utils.create_signed(self.user, usage_left=None)]
+        self.user.delete()
+
+        for key in keys:
+            self.assertEqual(self.backend.authenticate(key), None)
+
+        req = RequestFactory().get('/')
+        res = views.login(req, keys[0])
+        self.assertTrue(isinstance(res, HttpResponseRedirect))
+
+    def testValid(self):
+        oneweek = timezone.now() + timedelta(days=7)
+        key = utils.create_signed(self.user, expires=oneweek)
+
+        res = self.backend.authenticate(key)
+        self.assertEqual(res, self.user)
+        self.assertEqual(res.loginurl_key.expires,
+                         oneweek.replace(microsecond=0))
+
+    def testExpired(self):
+        oneweekago = timezone.now() - timedelta(days=7)
+        key = utils.create_signed(self.user, expires=oneweekago)
+
+        self.assertEqual(self.backend.authenticate(key), None)
+
+    def testTampered(self):
+        key = utils.create_signed(self.user)
+        payload, rest = key.split(':', 1)
+        key = '{}x:{}'.format(payload, rest)
+
+        self.assertEqual(self.backend.authenticate(key), None)
+
+class ReadDatabaseTestCase(BaseTestCase):
+    def setUp(self):
+        self.backend = backends.LoginUrlBackend()
+        BaseTestCase.setUp(self)
+
+    def testReplica(self):
+        data = utils.create(self.user)
+        before = metrics.routes['replica']
+
+        with override_settings(LOGINURL_READ_DATABASE='default'):
+            self.assertEqual(self.backend.authenticate(data.key), self.user)
+            self.assertEqual(self.backend.get_user(self.user.id), self.user)
+
+        self.assertEqual(metrics.routes['replica'], before + 2)
+        self.assertEqual(Key.objects.get(pk=data.pk).usage_left, 0)
+
+    def testFallback(self):
+        data = utils.create(self.user)
+        before = metrics.routes['fallback']
+        get_key = Key.objects.get_key
+
+        def lagging(key, using=None):
+            if using == 'replica':
+                raise Key.DoesNotExist
+            return get_key(key, using)
+
+        with override_settings(LOGINURL_READ_DATABASE='replica'):
+            with patch.object(Key.objects, 'get_key', lagging):
+                res = self.backend.authenticate(data.key)
+
+        self.assertEqual(res, self.user)
+        self.assertEqual(metrics.routes['fallback'], before + 1)
+
+class CacheStorageTestCase(BaseTestCase):
+    def setUp(self):
+        get_cache('default').clear()
+        self.backend = backends.LoginUrlBackend()
+        self.settings = override_settings(
+            LOGINURL_STORAGE='loginurl.storage.CacheStorage')
+        self.settings.enable()
+        BaseTestCase.setUp(self)
+
+    def tearDown(self):
+        self.settings.disable()
+
+    def testDefault(self):
+        data = utils.create(self.user, next='/next/page/')
+        self.assertEqual(Key.objects.count(), 0)
+
+        res = self.backend.authenticate(data.key)
+        self.assertEqual(res, self.user)
+        self.assertEqual(res.loginurl_key.next, '/next/page/')
+        self.assertEqual(res.loginurl_key.usage_left, 0)
+
+        self.assertEqual(self.backend.authenticate(data.key), None)
+
+    def testTenTimes(self):
+        data = utils.create(self.user, usage_left=10)
+
+        for i in range(10):
+            self.assertEqual(self.backend.authenticate(data.key), self.user)
+        self.assertEqual(self.backend.authenticate(data.key), None)
+
+    def testAlwaysValid(self):
+        data = utils.create(self.user, usage_left=None)
+
+        self.assertEqual(self.backend.authenticate(data.key), self.user)
+        self.assertEqual(self.backend.authenticate(data.key), self.user)
+
+    def testExpired(self):
+        oneweekago = timezone.now() - timedelta(days=7)
+        data = utils.create(self.user, expires=oneweekago)
+
+        self.assertEqual(self.backend.authenticate(data.key), None)
+
+    def testCreateMany(self):
+        users = [self.user, User.objects.create_user('test2')]
+        data = list(utils.create_many(users))
+
+        for user, key in zip(users, data):
+            self.assertEqual(self.backend.authenticate(key.key), user)
+
+    def testCleanUp(self):
+        utils.create(self.user)
+        self.assertEqual(utils.cleanup(), 0)
+
+    def testDeletedUser(self):
+        data = utils.create(self.user)
+        self.user.delete()
+
+        with patch.object(metrics, 'report') as report:
+            self.assertEqual(self.backend.authenticate(data.key), None)
+        report.assert_called_once_with(data.key, metrics.INVALID)
+
+    def testRevoke(self):
+        data = utils.create(self.user, usage_left=None)
+        other = utils.create(User.objects.create_user('test2'))
+
+        utils.revoke(self.user)
+        self.assertEqual(self.backend.authenticate(data.key), None)
+        self.assertEqual(self.backend.authenticate(other.key), other.user)
+
+        data = utils.create(self.user)
+        self.assertEqual(self.backend.authenticate(data.key), self.user)
+
+    def testMaxActiveKeys(self):
+        with override_settings(LOGINURL_MAX_ACTIVE_KEYS_PER_USER=1):
+            with patch.object(get_storage(), 'create_many') as create_many:
+                self.assertRaises(ImproperlyConfigured, utils.create,
+                                  self.user)
+        self.assertFalse(create_many.called)
+
+class CompactStorageTestCase(BaseTestCase):
+    def setUp(self):
+        CompactKey.objects.all().delete()
+        self.backend = backends.LoginUrlBackend()
+        self.settings = override_settings(
+            LOGINURL_STORAGE='loginurl.storage.CompactModelStorage')
+        self.settings.enable()
+        BaseTestCase.setUp(self)
+
+    def tearDown(self):
+        self.settings.disable()
+
+    def testDefault(self):
+        data = utils.create(self.user, next='/next/page/')
+        self.assertTrue(utils.is_valid_format(data.key))
+        self.assertEqual(Key.objects.count(), 0)
+
+        res = self.backend.authenticate(data.key)
+        self.assertEqual(res, self.user)
+        self.assertEqual(res.loginurl_key.next, '/next/page/')
+        self.assertEqual(res.loginurl_key.key, data.key)
+
+        self.assertEqual(self.backend.authenticate(data.key), None)
+
+    def testOtherUser(self):
+        other = User.objects.create_user('other')
+        data = utils.create(self.user)
+        uid, token = data.key.split('-')
+        key = '{}-{}'.format(int_to_base36(other.id), token)
+
+        self.assertEqual(self.backend.authenticate(key), None)
+
+    def testSharedTarget(self):
+        users = [self.user, User.objects.create_user('other')]
+        data = list(utils.create_many(users, next='/next/page/'))
+
+        self.assertEqual(data[0].target, data[1].target)
+        for user, key in zip(users, data):
+            self.assertEqual(self.backend.authenticate(key.key), user)
+
+    def testCleanUp(self):
+        utils.create(self.user, usage_left=0)
+        utils.create(self.user)
+
+        self.assertEqual(utils.cleanup(), 1)
+        self.assertEqual(CompactKey.objects.count(), 1)
+
+    def testCommand(self):
+        keys = [get_storage('loginurl.storage.ModelStorage').create(
+            self.user, 1, None, '/next/page/') for i in range(3)]
+        Key.objects.create(user=self.user, key='malformed')
+
+        out = StringIO()
+        management.call_command('loginurl_compact', batch_size=2, stdout=out)
+        management.call_command('loginurl_compact', delete=True, stdout=out)
+
+        self.assertEqual(CompactKey.objects.count(), 3)
+        self.assertEqual(Key.objects.count(), 1)
+        for data in keys:
+            self.assertEqual(self.backend.authenticate(data.key), self.user)
+
+class PartitionedStorageTestCase(BaseTestCase):
+    def setUp(self):
+        self.backend = backends.LoginUrlBackend()
+        self.settings = override_settings(
+            LOGINURL_STORAGE='loginurl.storage.PartitionedStorage')
+        self.settings.enable()
+        self.storage = get_storage()
+        self.dropTables()
+        BaseTestCase.setUp(self)
+
+    def tearDown(self):
+        self.dropTables()
+        self.settings.disable()
+
+    def dropTables(self):
+        with patch.object(self.storage, 'is_over', return_value=True):
+            for position, count in self.storage.iter_cleanup():
+                pass
+
+    def testDefault(self):
+        tomorrow = timezone.now() + timedelta(days=1)
+        data = utils.create(self.user, expires=tomorrow, next='/next/page/')
+        self.assertTrue(utils.is_valid_format(data.key))
+        self.assertEqual(Key.objects.count(), 0)
+
+        res = self.backend.authenticate(data.key)
+        self.assertEqual(res, self.user)
+        self.assertEqual(res.loginurl_key.next, '/next/page/')
+        self.assertEqual(res.loginurl_key.expires, tomorrow)
+        self.assertEqual(res.loginurl_key.usage_left, 0)
+
+        self.assertEqual(self.backend.authenticate(data.key), None)
+
+    def testNoExpiry(self):
+        data = utils.create(self.user)
+        self.assertEqual(Key.objects.count(), 1)
+        self.assertEqual(self.backend.authenticate(data.key), self.user)
+
+    def testUnknownPartition(self):
+        tomorrow = timezone.now() + timedelta(days=1)
+        data = utils.create(self.user, expires=tomorrow)
+        key = data.key.rsplit('-', 1)[0] + '-zzzz'
+
+        self.assertEqual(self.backend.authenticate(key), None)
+
+    def testUnknownPartitionListed(self):
+        tomorrow = timezone.now() + timedelta(days=1)
+        data = utils.create(self.user, expires=tomorrow)
+        uid, token, suffix = data.key.split('-')
+        self.storage._listed = 0
+
+        with patch.object(self.storage, '_list_tables',
+                          wraps=self.storage._list_tables) as list_tables:
+            for i in range(3):
+                key = '{}-{}-{}'.format(uid, token,
+                                        int_to_base36(100000 + i))
+                self.assertEqual(self.backend.authenticate(key), None)
+        self.assertEqual(list_tables.call_count, 1)
+
+    def testPartitionOver(self):
+        data = utils.create(self.user,
+                            expires=timezone.now() - timedelta(days=7))
+
+        with patch.object(self.storage, '_list_tables') as list_tables:
+            self.assertEqual(self.backend.authenticate(data.key), None)
+        self.assertFalse(list_tables.called)
+
+    def testCleanUp(self):
+        list(utils.create_many([self.user] * 3,
+                               expires=timezone.now() - timedelta(days=7)))
+        utils.create(self.user, expires=timezone.now() + timedelta(days=7))
+        utils.create(self.user, usage_left=0)
+
+        # The keys of the dropped tables are not counted on SQLite.
+        self.assertEqual(self.storage.count_invalid(), 1)
+        self.assertEqual(utils.cleanup(), 1)
+        self.assertEqual(len(self.storage._list_tables()), 1)
+        self.assertEqual(Key.objects.count(), 0)
+
+    def testActiveKeys(self):
+        nextweek = timezone.now() + timedelta(days=7)
+        old = utils.create(self.user)
+        new = utils.create(self.user, expires=nextweek)
+        utils.create(self.user, expires=nextweek, usage_left=0)
+        utils.create(self.user, expires=timezone.now() - timedelta(days=7))
+
+        self.assertEqual([data.key for data in utils.active_keys(self.user)],
+                         [new.key, old.key])
+
+        self.assertEqual(utils.revoke(self.user), 2)
+        self.assertEqual(utils.active_keys(self.user), [])
+        self.assertEqual(self.backend.authenticate(new.key), None)
+
+    def testMaxActiveKeys(self):
+        nextweek = timezone.now() + timedelta(days=7)
+        with override_settings(LOGINURL_MAX_ACTIVE_KEYS_PER_USER=1):
+            first = utils.create(self.user)
+            second = utils.create(self.user, expires=nextweek)
+            third = utils.create(self.user, expires=nextweek)
+
+        self.assertEqual([data.key for data in utils.active_keys(self.user)],
+                         [third.key])
+        self.assertEqual(self.backend.authenticate(first.key), None)
+        self.assertEqual(self.backend.authenticate(second.key), None)
+        self.assertEqual(self.backend.authenticate(third.key), self.user)
+
+class StatelessLoginTestCase(BaseTestCase):
+    def setUp(self):
+        get_cache('default').clear()
+        BaseTestCase.setUp(self)
+        self.factory = RequestFactory()
+
+        @key_required
+        def view(request):
+            return HttpResponse(request.user.username)
+        self.view = view
+
+    def testHeader(self):
+        data = utils.create(self.user)
+        request = self.factory.get('/', HTTP_X_LOGINURL_KEY=data.key)
+
+        res = self.view(request)
+        self.assertEqual(res.content, b'test')
+        self.assertFalse(hasattr(request, 'session'))
+
+        res = self.view(self.factory.get('/', HTTP_X_LOGINURL_KEY=data.key))
+        self.assertEqual(res.status_code, 403)
+
+    def testParameter(self):
+        data = utils.create(self.user)
+
+        res = self.view(self.factory.get('/', {'loginurl_key': data.key}))
+        self.assertEqual(res.content, b'test')
+
+        data = utils.create(self.user)
+        with override_settings(LOGINURL_PARAMETER=None):
+            res = self.view(self.factory.get('/', {'loginurl_key': data.key}))
+        self.assertEqual(res.status_code, 403)
+
+    def testUrlArgument(self):
+        data = utils.create(self.user)
+
+        res = self.view(self.factory.get('/'), key=data.key)
+        self.assertEqual(res.content, b'test')
+
+    def testMissing(self):
+        self.assertEqual(self.view(self.factory.get('/')).status_code, 403)
+
+    def testMiddleware(self):
+        data = utils.create(self.user)
+        middleware = LoginUrlMiddleware()
+
+        request = self.factory.get('/', HTTP_X_LOGINURL_KEY=data.key)
+        request.user = None
+        self.assertEqual(middleware.process_request(request), None)
+        self.assertEqual(request.user, self.user)
+
+        request = self.factory.get('/', HTTP_X_LOGINURL_KEY=data.key)
+        request.user = None
+        middleware.process_request(request)
+        self.assertEqual(request.user, None)
+
 class ViewCleanUpTestCase(unittest.TestCase):
     def testCleanUp(self):
         mock = Mock()
+        mock.return_value = 3
 
         @patch.object(utils, 'cleanup', mock)
         def test():
@@ -217,11 +1253,12 @@ class ViewCleanUpTestCase(unittest.TestCase):
         self.assertTrue(mock.called)
         self.assertTrue(isinstance(res, HttpResponse))
         self.assertTrue(res.status_code, 200)
+        self.assertTrue(res.content.startswith(b'ok\n3 keys removed'))
 
 class ViewLoginTestCae(BaseTestCase):
     def testDefault(self):
         auth = Mock()
-        auth.authenticate.return_value = self.user
+        auth.authenticate.side_effect = backends.LoginUrlBackend().authenticate
 
         req = Mock()
         req.GET.get.return_value = None
@@ -261,7 +1298,7 @@ class ViewLoginTestCae(BaseTestCase):
 
     def testNextFromDB(self):
         auth = Mock()
-        auth.authenticate.return_value = self.user
+        auth.authenticate.side_effect = backends.LoginUrlBackend().authenticate
 
         req = Mock()
         req.GET.get.return_value = None
@@ -283,7 +1320,7 @@ class ViewLoginTestCae(BaseTestCase):
 
     def testNextFromQueryString(self):
         auth = Mock()
-        auth.authenticate.return_value = self.user
+        auth.authenticate.side_effect = backends.LoginUrlBackend().authenticate
 
         req = Mock()
         req.GET.get.return_value = '/next/page/'
@@ -305,7 +1342,7 @@ class ViewLoginTestCae(BaseTestCase):
 
     def testNext(self):
         auth = Mock()
-        auth.authenticate.return_value = self.user
+        auth.authenticate.side_effect = backends.LoginUrlBackend().authenticate
 
         req = Mock()
         req.GET.get.return_value = '/next/query-string/'
@@ -342,17 +1379,411 @@ class ViewLoginTestCae(BaseTestCase):
         self.assertTrue(isinstance(res, HttpResponseRedirect))
         self.assertEqual(res['Location'], next)
 
-class CommandTestCase(unittest.TestCase):
+class CommandTestCase(BaseTestCase):
+    def setUp(self):
+        BaseTestCase.setUp(self)
+        get_cache('default').clear()
+
+        oneweekago = timezone.now() - timedelta(days=7)
+        for i in range(3):
+            utils.create(self.user, usage_left=0)
+            utils.create(self.user, expires=oneweekago)
+        utils.create(self.user)
+
+    def call(self, **options):
+        out = StringIO()
+        options.setdefault('stderr', StringIO())
+        management.call_command('loginurl_cleanup', stdout=out, **options)
+        return out.getvalue()
+
     def testCall(self):
-        from loginurl.management.commands import loginurl_cleanup
+        out = self.call()
 
-        mock = Mock()
+        self.assertTrue(out.startswith('6 keys removed'))
+        self.assertEqual(Key.objects.count(), 1)
 
-        @patch.object(utils, 'cleanup', mock)
-        def test():
-            management.call_command('loginurl_cleanup')
+    def testDryRun(self):
+        out = self.call(dry_run=True)
 
-        test()
+        self.assertTrue(out.startswith('6 keys would be removed'))
+        self.assertEqual(Key.objects.count(), 7)
 
-        self.assertTrue(mock.called)
+    def testOlderThan(self):
+        Key.objects.update(created=timezone.now() - timedelta(days=30))
+
+        out = self.call(older_than=10)
+
+        self.assertTrue(out.startswith('7 keys removed'))
+        self.assertEqual(Key.objects.count(), 0)
+
+    def testResume(self):
+        out = self.call(batch_size=2, max_rows=2)
+        self.assertTrue(out.startswith('2 keys removed'))
+        self.assertTrue('continue' in out)
+        self.assertEqual(Key.objects.count(), 5)
+
+        out = self.call(batch_size=2)
+        self.assertTrue(out.startswith('4 keys removed'))
+        self.assertEqual(Key.objects.count(), 1)
+        self.assertEqual(get_cache('default').get(
+            'loginurl:cleanup:position'), None)
+
+    def testResumeFile(self):
+        import os
+        import tempfile
+
+        position_file = os.path.join(tempfile.mkdtemp(), 'position')
+        err = StringIO()
+        out = self.call(batch_size=2, max_rows=2, position_file=position_file,
+                        stderr=err)
+        self.assertTrue(out.startswith('2 keys removed'))
+        self.assertTrue(os.path.exists(position_file))
+        self.assertEqual(err.getvalue(), '')
+        get_cache('default').clear()
+
+        out = self.call(batch_size=2, position_file=position_file)
+        self.assertTrue(out.startswith('4 keys removed'))
+        self.assertFalse(os.path.exists(position_file))
+        os.rmdir(os.path.dirname(position_file))
+
+    def testLocalCacheWarning(self):
+        err = StringIO()
+        self.call(batch_size=2, max_rows=2, stderr=err)
+        self.assertTrue('--position-file' in err.getvalue())
+
+class AdminTestCase(BaseTestCase):
+    def setUp(self):
+        BaseTestCase.setUp(self)
+        self.admin = KeyAdmin(Key, site)
+        self.request = Mock()
+
+        oneweek = timezone.now() + timedelta(days=7)
+        self.valid = utils.create(self.user, expires=oneweek)
+        self.used = utils.create(self.user, usage_left=0)
+        self.always = utils.create(self.user, usage_left=None)
+
+    def testExpire(self):
+        with patch.object(self.admin, 'message_user'):
+            self.admin.expire(self.request, Key.objects.all())
+        self.assertEqual(Key.objects.filter(
+            expires__lte=timezone.now()).count(), 3)
+
+    def testExtend(self):
+        with patch.object(self.admin, 'message_user'):
+            self.admin.extend(self.request, Key.objects.all())
+
+        datadb = Key.objects.get(pk=self.valid.pk)
+        self.assertEqual(datadb.expires, self.valid.expires + timedelta(days=7))
+        self.assertEqual(Key.objects.get(pk=self.used.pk).expires, None)
+
+    def testRevoke(self):
+        with patch.object(self.admin, 'message_user'):
+            self.admin.revoke(self.request, Key.objects.all())
+        self.assertEqual(Key.objects.filter(usage_left=0).count(), 3)
+
+    def testValidityFilter(self):
+        def keys(value):
+            data = ValidityListFilter(None, {'validity': value}, Key,
+                                      self.admin)
+            return set(data.queryset(None, Key.objects.all()))
+
+        self.assertEqual(keys('valid'), set([self.valid, self.always]))
+        self.assertEqual(keys('used'), set([self.used]))
+        self.assertEqual(keys('expired'), set())
+
+    def testPaginator(self):
+        self.assertEqual(LargeTablePaginator(Key.objects.all(), 10).count, 3)
+
+        with override_settings(LOGINURL_ADMIN_COUNT_LIMIT=2):
+            paginator = LargeTablePaginator(Key.objects.filter(user=self.user),
+                                            10)
+            self.assertEqual(paginator.count, 2)
+
+    def testChangeList(self):
+        superuser = User.objects.create_superuser('admin', 'admin@example.com',
+                                                  'admin')
+        request = RequestFactory().get('/admin/', {'validity': 'valid'})
+        request.user = superuser
+
+        with override_settings(LOGINURL_ADMIN_COUNT_LIMIT=1):
+            res = self.admin.changelist_view(request)
+
+        changelist = res.context_data['cl']
+        self.assertTrue(isinstance(changelist, LargeTableChangeList))
+        self.assertEqual(changelist.result_count, 1)
+        self.assertEqual(changelist.full_result_count, 1)
+        superuser.delete()
+
+    def testExport(self):
+        request = RequestFactory().get('/admin/', HTTP_HOST='example.com')
+        with override_settings(ROOT_URLCONF='loginurl.urls'):
+            res = self.admin.export_urls(request, Key.objects.filter(
+                pk=self.valid.pk))
+            content = b''.join(res.streaming_content).decode('utf-8')
+
+        self.assertEqual(content, 'email,url\r\ntest@example.com,'
+                         'http://example.com/{}/\r\n'.format(self.valid.key))
+
+class ExportTestCase(BaseTestCase):
+    def setUp(self):
+        self.settings = override_settings(ROOT_URLCONF='loginurl.urls')
+        self.settings.enable()
+        BaseTestCase.setUp(self)
+        self.keys = [data.key for data in utils.create_many([self.user] * 3)]
+
+    def tearDown(self):
+        self.settings.disable()
+
+    def testRows(self):
+        batches = list(export.iter_rows(Key.objects.all(), batch_size=2,
+                                        base_url='https://example.com/'))
+
+        self.assertEqual([len(rows) for rows in batches], [2, 1])
+        self.assertEqual(batches[0][0], ('test@example.com',
+            'https://example.com/{}/'.format(self.keys[0])))
+
+    def testFormats(self):
+        user = User.objects.create_user('other', 'a,"b"@example.com')
+        key = utils.create(user).key
+        queryset = Key.objects.filter(user=user)
+
+        csv = ''.join(export.iter_export(queryset))
+        self.assertEqual(csv, 'email,url\r\n"a,""b""@example.com",'
+                         '/{}/\r\n'.format(key))
+
+        lines = ''.join(export.iter_export(queryset, 'jsonl')).splitlines()
+        self.assertEqual([json.loads(line) for line in lines],
+                         [{'email': 'a,"b"@example.com', 'url': '/' + key + '/'}])
+
+    def testGzip(self):
+        import gzip
+
+        data = b''.join(export.iter_export(Key.objects.all(), compress=True))
+        content = gzip.GzipFile(fileobj=BytesIO(data)).read().decode('utf-8')
+
+        self.assertEqual(content.count('\n'), 4)
+
+    def testCommand(self):
+        Key.objects.filter(key=self.keys[0]).update(usage_left=0)
+
+        out = StringIO()
+        management.call_command('loginurl_export', format='jsonl', valid=True,
+                                base_url='https://example.com', stdout=out)
+
+        urls = [json.loads(line)['url']
+                for line in out.getvalue().splitlines()]
+        self.assertEqual(urls, ['https://example.com/{}/'.format(key)
+                                for key in self.keys[1:]])
+
+    def testOtherStorage(self):
+        with override_settings(
+                LOGINURL_STORAGE='loginurl.storage.PartitionedStorage'):
+            self.assertRaises(management.CommandError,
+                              management.call_command, 'loginurl_export',
+                              stdout=StringIO())
+
+class AuditTestCase(BaseTestCase):
+    def setUp(self):
+        KeyEvent.objects.all().delete()
+        audit.flush()
+        audit._flusher = None
+        self.settings = override_settings(LOGINURL_AUDIT=True,
+                                          LOGINURL_AUDIT_FLUSH_INTERVAL=0,
+                                          LOGINURL_AUDIT_BATCH_SIZE=3)
+        self.settings.enable()
+        BaseTestCase.setUp(self)
+
+    def tearDown(self):
+        audit.flush()
+        audit._flusher = None
+        self.settings.disable()
 
+    def actions(self):
+        return list(KeyEvent.objects.order_by('pk')
+                                    .values_list('action', flat=True))
+
+    def testBuffered(self):
+        data = utils.create(self.user)
+        list(utils.create_many([self.user]))
+        self.assertEqual(KeyEvent.objects.count(), 0)
+
+        utils.create(self.user)
+        self.assertEqual(self.actions(), [audit.ISSUED] * 3)
+        event = KeyEvent.objects.order_by('pk')[0]
+        self.assertEqual(event.key, audit.digest(data.key))
+        self.assertNotEqual(event.key, data.key)
+        self.assertEqual(event.user, self.user)
+
+    def testSearch(self):
+        data = utils.create(self.user)
+        utils.create(self.user)
+        audit.flush()
+
+        model_admin = site._registry[KeyEvent]
+        queryset = model_admin.get_search_results(
+            Mock(), KeyEvent.objects.all(), ' {} '.format(data.key))[0]
+        self.assertEqual([event.key for event in queryset],
+                         [audit.digest(data.key)])
+
+    def testFlusherError(self):
+        with patch.object(audit._wake, 'wait'), \
+             patch.object(audit.logger, 'exception') as exception:
+            with patch.object(audit, 'flush',
+                              side_effect=[DatabaseError, SystemExit]) as flush:
+                self.assertRaises(SystemExit, audit._run, 1)
+        self.assertEqual(flush.call_count, 2)
+        self.assertEqual(exception.call_count, 1)
+
+    def testLogin(self):
+        data = utils.create(self.user)
+        factory = RequestFactory()
+
+        with patch.object(views.auth, 'login'):
+            views.login(factory.get('/', REMOTE_ADDR='10.0.0.1'), data.key)
+            views.login(factory.get('/', REMOTE_ADDR='10.0.0.2'), data.key)
+        self.assertEqual(audit.flush(), 0)
+
+        events = list(KeyEvent.objects.order_by('pk'))
+        self.assertEqual([(event.action, event.ip) for event in events],
+                         [(audit.ISSUED, None),
+                          (audit.SUCCESS, '10.0.0.1'),
+                          (audit.FAILURE, '10.0.0.2')])
+
+    def testCleanUp(self):
+        utils.create(self.user, usage_left=0)
+        utils.cleanup()
+        audit.flush()
+
+        event = KeyEvent.objects.get(action=audit.CLEANUP)
+        self.assertEqual(event.detail, '1 keys removed')
+
+    def testDisabled(self):
+        with override_settings(LOGINURL_AUDIT=False):
+            utils.create(self.user)
+        self.assertEqual(audit.flush(), 0)
+
+    def testMaxBuffer(self):
+        dropped = audit.dropped
+        with override_settings(LOGINURL_AUDIT_MAX_BUFFER=1,
+                               LOGINURL_AUDIT_BATCH_SIZE=10):
+            utils.create(self.user)
+            utils.create(self.user)
+
+        self.assertEqual(audit.flush(), 1)
+        self.assertEqual(audit.dropped, dropped + 1)
+
+    def testPrune(self):
+        KeyEvent.objects.create(action=audit.ISSUED,
+                                created=timezone.now() - timedelta(days=100))
+        KeyEvent.objects.create(action=audit.ISSUED)
+
+        management.call_command('loginurl_audit_prune', stdout=StringIO())
+        self.assertEqual(KeyEvent.objects.count(), 1)
+
+class MetricsTestCase(BaseTestCase):
+    def setUp(self):
+        BaseTestCase.setUp(self)
+        self.client = metrics.MemoryClient()
+        self.adapter = metrics.StatsdAdapter(self.client)
+        self.adapter.connect()
+
+    def tearDown(self):
+        self.adapter.disconnect()
+
+    def login(self, key):
+        req = RequestFactory().get('/')
+        SessionMiddleware().process_request(req)
+        return views.login(req, key)
+
+    def testLogin(self):
+        data = utils.create(self.user)
+        self.login(data.key)
+
+        self.assertEqual(len(self.client.timings['loginurl.create']), 1)
+        self.assertEqual(len(self.client.timings['loginurl.login']), 1)
+        self.assertEqual(
+            len(self.client.timings['loginurl.login.authenticate']), 1)
+        self.assertEqual(len(self.client.timings['loginurl.login.session']), 1)
+        self.assertTrue(self.client.counters['loginurl.login.queries'] > 0)
+        self.assertEqual(self.client.counters['loginurl.key.success'], 1)
+
+    def testOutcomes(self):
+        oneweekago = timezone.now() - timedelta(days=7)
+        exhausted = utils.create(self.user, usage_left=0)
+        expired = utils.create(self.user, expires=oneweekago)
+        before = dict(metrics.outcomes)
+
+        self.login(exhausted.key)
+        self.login(expired.key)
+        self.login('invalid-key')
+
+        counters = self.client.counters
+        self.assertEqual(counters['loginurl.key.exhausted'], 1)
+        self.assertEqual(counters['loginurl.key.expired'], 1)
+        self.assertEqual(counters['loginurl.key.invalid'], 1)
+        self.assertEqual(metrics.outcomes['invalid'],
+                         before.get('invalid', 0) + 1)
+
+    def testCleanUp(self):
+        utils.cleanup()
+        self.assertEqual(len(self.client.timings['loginurl.cleanup']), 1)
+
+    def testQueriesNotLogged(self):
+        from django.db import connection
+
+        before = len(connection.queries)
+        with override_settings(DEBUG=False):
+            data = utils.create(self.user)
+            self.login(data.key)
+
+        self.assertEqual(len(connection.queries), before)
+        self.assertFalse(connection.use_debug_cursor)
+        self.assertTrue(self.client.counters['loginurl.login.queries'] > 0)
+
+    def testDisconnected(self):
+        self.adapter.disconnect()
+        utils.create(self.user)
+        self.assertEqual(len(self.client.timings), 0)
+
+class BenchmarkTestCase(BaseTestCase):
+    def testCall(self):
+        out = StringIO()
+        management.call_command('loginurl_benchmark', create=5, sizes='10,20',
+                                logins=3, stdout=out)
+        results = json.loads(out.getvalue())
+
+        self.assertEqual(results['create']['keys'], 5)
+        self.assertEqual(results['create_many']['keys'], 5)
+        self.assertEqual([item['table_size'] for item in results['login']],
+                         [13, 23])
+        self.assertTrue(results['login'][0]['queries_per_login'] > 0)
+        self.assertEqual(results['cleanup']['rows'], 23)
+
+        self.assertEqual(Key.objects.count(), 0)
+        self.assertFalse(User.objects.filter(
+            username='loginurl-benchmark').exists())
+
+class StressTestCase(BaseTestCase):
+    def testCall(self):
+        out = StringIO()
+        management.call_command('loginurl_stress', threads=1, attempts=5,
+                                stdout=out)
+        results = json.loads(out.getvalue())
+
+        self.assertEqual(results['one-time']['logins'], 1)
+        self.assertEqual(results['multi-use']['logins'], 2)
+        self.assertEqual(results['distinct']['logins'], 5)
+        self.assertEqual(Key.objects.count(), 0)
+        self.assertFalse(User.objects.filter(
+            username='loginurl-stress').exists())
+
+    def testOverConsumption(self):
+        with patch.object(Key, 'update_usage', return_value=True):
+            self.assertRaises(management.CommandError,
+                              management.call_command, 'loginurl_stress',
+                              threads=1, attempts=3, scenarios='one-time',
+                              stdout=StringIO())
+
+    def testMemoryDatabase(self):
+        self.assertRaises(management.CommandError, management.call_command,
+                          'loginurl_stress', threads=2, stdout=StringIO())
@@ -0,0 +1,97 @@
+"""
+Fast rejection of invalid keys.
+
+These helpers keep track of invalid keys and failed log in attempts in the
+cache selected by ``settings.LOGINURL_CACHE``, so that repeated attempts can
+be rejected without looking up the key storage.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import get_cache
+
+from loginurl import utils
+
+def _cache():
+    return get_cache(getattr(settings, 'LOGINURL_CACHE', 'default'))
+
+def _invalid_name(key):
+    # Signed keys can be longer than what some caches accept as a key name.
+    digest = hashlib.md5(key.encode('utf-8')).hexdigest()
+    return 'loginurl:invalid:{}'.format(digest)
+
+def is_known_invalid(key):
+    """
+    Check if the key has recently been found to be invalid.
+
+    This is only enabled if ``settings.LOGINURL_NEGATIVE_CACHE_TIMEOUT`` is
+    set to the number of seconds an invalid key is remembered.
+    """
+    if not getattr(settings, 'LOGINURL_NEGATIVE_CACHE_TIMEOUT', 0):
+        return False
+    return _cache().get(_invalid_name(key)) is not None
+
+def remember_invalid(key):
+    """
+    Remember that the key is invalid, see ``is_known_invalid``.
+    """
+    timeout = getattr(settings, 'LOGINURL_NEGATIVE_CACHE_TIMEOUT', 0)
+    if timeout:
+        _cache().set(_invalid_name(key), 1, timeout)
+
+def _is_plausible(key):
+    from loginurl import bloom
+
+    return utils.is_valid_format(key) and bloom.might_exist(key)
+
+def _failure_names(request, key, counting=False):
+    names = ['loginurl:failures:ip:{}'.format(
+        request.META.get('REMOTE_ADDR', ''))]
+    if not getattr(settings, 'LOGINURL_RATE_LIMIT_PER_USER', False) or \
+       utils.is_signed(key):
+        return names
+
+    # The user id is chosen by the visitor, so only keys that could exist are
+    # counted against it. Otherwise anyone could lock a user out.
+    if counting and not _is_plausible(key):
+        return names
+
+    names.append('loginurl:failures:uid:{}'.format(key.split('-', 1)[0]))
+    return names
+
+def is_throttled(request, key):
+    """
+    Check if there have been too many failed log in attempts from the address
+    of the request, or for the user id encoded in the key if
+    ``settings.LOGINURL_RATE_LIMIT_PER_USER`` is ``True``.
+
+    The limit is set by ``settings.LOGINURL_RATE_LIMIT``, which is a
+    ``(attempts, seconds)`` pair allowing ``attempts`` failed attempts in
+    ``seconds`` seconds. There is no limit by default. Failed attempts are
+    only counted for a user id if the key is well formed and not rejected by
+    ``loginurl.bloom``.
+    """
+    limit = getattr(settings, 'LOGINURL_RATE_LIMIT', None)
+    if not limit:
+        return False
+
+    attempts, seconds = limit
+    failures = _cache().get_many(_failure_names(request, key))
+    return any(count >= attempts for count in failures.values())
+
+def add_failure(request, key):
+    """
+    Count a failed log in attempt, see ``is_throttled``.
+    """
+    limit = getattr(settings, 'LOGINURL_RATE_LIMIT', None)
+    if not limit:
+        return
+
+    attempts, seconds = limit
+    cache = _cache()
+    for name in _failure_names(request, key, counting=True):
+        cache.add(name, 0, seconds)
+        try:
+            cache.incr(name)
+        except ValueError:
+            pass
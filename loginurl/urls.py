@@ -6,7 +6,8 @@ from loginurl.views import cleanup, login
 
 urlpatterns = patterns('',
     (r'^cleanup/$', cleanup),
-    (r'^(?P<key>[0-9A-Za-z]+-[a-z0-9-]+)/$', login), 
+    url(r'^(?P<key>[0-9A-Za-z]+-[a-z0-9-]+)/$', login, name='loginurl-login'),
+    (r'^(?P<key>[0-9A-Za-z_.:-]+:[0-9A-Za-z_-]+)/$', login),
     url(r'^$', name='loginurl-index', view=RedirectView.as_view(
         permanent=True,
         url=settings.LOGIN_URL,
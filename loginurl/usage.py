@@ -0,0 +1,268 @@
+"""
+Write-behind counting of key usages.
+
+Spending a usage of a key normally updates its row, so all the log ins with a
+shared multi-use key wait for the same row lock. When
+``settings.LOGINURL_USAGE_WRITE_BEHIND`` is set, the usages of keys with at
+least ``settings.LOGINURL_USAGE_WRITE_BEHIND_MIN`` usages left (100 by
+default) are counted outside of the database instead, and the rows are
+updated in batches by ``flush``.
+
+``LOGINURL_USAGE_WRITE_BEHIND`` selects where the usages are counted:
+
+``'cache'``
+    In the cache named by ``settings.LOGINURL_CACHE``, which is shared by all
+    processes, so the usage limit is enforced exactly as long as the cache
+    does not lose the counters.
+
+``'local'``
+    In each process. ``flush`` subtracts the usages spent by the process
+    since the last flush from the rows, and reads back the usages left, which
+    include the ones spent by the other processes. A key may still be used
+    more than its limit by the usages spent in the other processes since the
+    last flush.
+
+In the cache, the number of usages left when a key is first counted and the
+number of usages spent since then are kept for
+``settings.LOGINURL_USAGE_TIMEOUT`` seconds (one day by default). These
+counters are never decremented, so ``flush`` can write the number of usages
+left at any time without losing updates. In each process, the counters are
+kept for the same time.
+"""
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.db import connection
+from django.db.models import F
+
+from loginurl.cache import StripedCounter
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_dirty = set()
+_seeded = set()
+_local = StripedCounter()
+_flusher = None
+
+def _counters():
+    mode = getattr(settings, 'LOGINURL_USAGE_WRITE_BEHIND', None)
+    if mode == 'cache':
+        return get_cache(getattr(settings, 'LOGINURL_CACHE', 'default'))
+    return _local
+
+def _name(model, pk):
+    return 'loginurl:usage:{}:{}'.format(model._meta.db_table, pk)
+
+def is_enabled(data):
+    """
+    Check if the usages of a key are counted by ``spend``.
+    """
+    if not getattr(settings, 'LOGINURL_USAGE_WRITE_BEHIND', None):
+        return False
+    minimum = getattr(settings, 'LOGINURL_USAGE_WRITE_BEHIND_MIN', 100)
+    return data.usage_left is not None and data.usage_left >= minimum
+
+def spend(data):
+    """
+    Spend a usage of a saved key without updating its row.
+
+    Returns ``True`` if a usage was spent, ``False`` if the key is used up, or
+    ``None`` if the counters are not available and the row has to be updated
+    instead.
+    """
+    counters = _counters()
+    model = type(data)
+    name = _name(model, data.pk)
+    timeout = getattr(settings, 'LOGINURL_USAGE_TIMEOUT', 86400)
+
+    if counters is _local:
+        return _spend_local(data, model, name, timeout)
+
+    counters.add(name + ':left', data.usage_left, timeout)
+    counters.add(name + ':used', 0, timeout)
+    try:
+        used = counters.incr(name + ':used')
+    except ValueError:
+        return None
+    left = counters.get_many([name + ':left']).get(name + ':left')
+    if left is None:
+        return None
+
+    with _lock:
+        _dirty.add((model, data.pk))
+    _start_flusher()
+
+    if used > left:
+        data.usage_left = 0
+        return False
+
+    data.usage_left = left - used
+    return True
+
+def _spend_local(data, model, name, timeout):
+    # ':left' is the number of usages left as seen by this process, ':used'
+    # the number of usages not flushed yet, and ':row' the number of usages
+    # left in the row when it was last read, minus the usages flushed since.
+    _local.add(name + ':left', data.usage_left, timeout)
+    _local.add(name + ':row', data.usage_left, timeout)
+    _local.add(name + ':used', 0, timeout)
+    try:
+        left = _local.incr(name + ':left', -1)
+        if left < 0:
+            _local.incr(name + ':left')
+        else:
+            _local.incr(name + ':used')
+    except ValueError:
+        return None
+
+    with _lock:
+        _seeded.add((model, data.pk))
+        if left >= 0:
+            _dirty.add((model, data.pk))
+    _start_flusher()
+
+    if left < 0:
+        data.usage_left = 0
+        return False
+
+    data.usage_left = left
+    return True
+
+def flush(close=False):
+    """
+    Write the number of usages left of the keys counted by this process to
+    the database. Returns the number of keys written.
+
+    Rows are only updated if they have more usages left, or have the usages
+    spent subtracted when counting in each process, so keys revoked in the
+    meantime stay revoked. The keys are written again by the next call if
+    this one fails.
+    """
+    global _dirty
+
+    with _lock:
+        dirty, _dirty = _dirty, set()
+
+    counters = _counters()
+    try:
+        if counters is _local:
+            return _flush_local(dirty)
+        return _flush_cache(counters, dirty)
+    except Exception:
+        with _lock:
+            _dirty.update(dirty)
+        raise
+    finally:
+        if counters is _local:
+            _local.prune()
+        if close:
+            connection.close()
+
+def _flush_cache(counters, dirty):
+    count = 0
+    for model, pk in dirty:
+        name = _name(model, pk)
+        values = counters.get_many([name + ':left', name + ':used'])
+        if len(values) < 2:
+            continue
+
+        left = max(values[name + ':left'] - values[name + ':used'], 0)
+        model._default_manager.filter(pk=pk, usage_left__gt=left) \
+                              .update(usage_left=left)
+        count += 1
+    return count
+
+def _flush_local(dirty):
+    with _flush_lock:
+        count = 0
+        for model, pk in dirty:
+            name = _name(model, pk)
+            used = _local.get_many([name + ':used']).get(name + ':used')
+            if not used:
+                continue
+
+            _local.incr(name + ':used', -used)
+            try:
+                manager = model._default_manager
+                if not manager.filter(pk=pk, usage_left__gte=used) \
+                              .update(usage_left=F('usage_left') - used):
+                    manager.filter(pk=pk, usage_left__gt=0) \
+                           .update(usage_left=0)
+            except Exception:
+                _local.incr(name + ':used', used)
+                raise
+            _local.incr(name + ':row', -used)
+            count += 1
+
+        _reseed()
+        return count
+
+def _reseed():
+    """
+    Read the usages left of the keys counted by this process, to take the
+    usages spent by the other processes into account.
+    """
+    with _lock:
+        seeded = list(_seeded)
+
+    models = {}
+    for model, pk in seeded:
+        models.setdefault(model, []).append(pk)
+
+    for model, pks in models.items():
+        rows = dict(model._default_manager.filter(pk__in=pks)
+                                          .values_list('pk', 'usage_left'))
+        for pk in pks:
+            name = _name(model, pk)
+            values = _local.get_many([name + ':row'])
+            if not values:
+                with _lock:
+                    _seeded.discard((model, pk))
+                continue
+
+            left = rows.get(pk) or 0
+            change = left - values[name + ':row']
+            if change:
+                try:
+                    _local.incr(name + ':left', change)
+                    _local.incr(name + ':row', change)
+                except ValueError:
+                    pass
+
+def _run(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            flush(close=True)
+        except Exception:
+            logger.exception('Error while writing the key usages')
+
+def _start_flusher():
+    """
+    Start the thread flushing the counters every
+    ``settings.LOGINURL_USAGE_FLUSH_INTERVAL`` seconds (5 by default), if it
+    is not running yet. The counters are also flushed when the process exits.
+    """
+    global _flusher
+
+    if _flusher is not None:
+        return
+
+    with _lock:
+        if _flusher is not None:
+            return
+
+        interval = getattr(settings, 'LOGINURL_USAGE_FLUSH_INTERVAL', 5)
+        if interval:
+            _flusher = threading.Thread(target=_run, args=(interval,))
+            _flusher.daemon = True
+            _flusher.start()
+        else:
+            _flusher = False
+        atexit.register(flush)
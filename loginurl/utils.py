@@ -1,31 +1,219 @@
+import os
+import re
 import uuid
-import hashlib
+import random
+import binascii
+import calendar
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from itertools import islice
 
-from django.db.models import Q
 from django.conf import settings
+from django.core import signing
+from django.core.cache import get_cache
+from django.db import connection
+from django.db.models.query import QuerySet
 from django.utils import timezone
-from django.utils.http import int_to_base36
+from django.utils.http import int_to_base36, base36_to_int
 
-def _create_token(user):
+SIGNED_SALT = 'loginurl.signed'
+
+# User id, token and an optional suffix used by storages, e.g. the partition of
+# ``storage.PartitionedStorage``.
+KEY_RE = re.compile(r'^([0-9a-z]+)-([0-9a-f]{32})(?:-([0-9a-z]+))?$')
+
+_cleanup_lock = threading.Lock()
+
+_token_pool = None
+
+TOKEN_BYTES = 16
+
+_tokens = deque()
+_tokens_pid = None
+
+def random_tokens(count):
+    """
+    Return ``count`` random tokens of ``TOKEN_BYTES`` bytes, hex encoded.
+
+    The random bytes of all the tokens are read from ``os.urandom`` and hex
+    encoded in one go, then sliced into tokens.
+    """
+    size = TOKEN_BYTES * 2
+    data = binascii.hexlify(os.urandom(TOKEN_BYTES * count)).decode('ascii')
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+def _create_token(user=None):
+    """
+    Create a unique token.
+
+    Tokens are generated ``settings.LOGINURL_TOKEN_CHUNK_SIZE`` (256 by
+    default) at a time by ``random_tokens`` and handed out one by one. Tokens
+    generated before the process forked are thrown away, so that processes
+    never share them.
+    """
+    global _tokens_pid
+
+    pid = os.getpid()
+    if _tokens_pid != pid:
+        _tokens.clear()
+        _tokens_pid = pid
+
+    try:
+        return _tokens.popleft()
+    except IndexError:
+        tokens = random_tokens(getattr(settings, 'LOGINURL_TOKEN_CHUNK_SIZE',
+                                       256))
+        token = tokens.pop()
+        _tokens.extend(tokens)
+        return token
+
+class TokenPool(object):
+    """
+    A pool of tokens generated ahead of time.
+
+    ``get`` takes a token from the pool. When the number of tokens left falls
+    below ``low_water``, a background thread refills the pool up to ``size``
+    tokens. If the pool is empty, a token is generated on the spot. The number
+    of tokens taken from the pool and generated on the spot are counted in
+    ``hits`` and ``misses``.
+    """
+    def __init__(self, size, low_water):
+        self.size = size
+        self.low_water = low_water
+        self.hits = 0
+        self.misses = 0
+        self._tokens = deque()
+        self._lock = threading.Lock()
+        self._refilling = False
+        self._pid = os.getpid()
+
+    def generate(self):
+        return random_tokens(1)[0]
+
+    def refill(self):
+        """
+        Fill the pool up to ``size`` tokens.
+        """
+        try:
+            missing = self.size - len(self._tokens)
+            if missing > 0:
+                self._tokens.extend(random_tokens(missing))
+        finally:
+            self._refilling = False
+
+    def _start_refill(self):
+        with self._lock:
+            if self._refilling:
+                return
+            self._refilling = True
+
+        thread = threading.Thread(target=self.refill)
+        thread.daemon = True
+        thread.start()
+
+    def get(self):
+        # Tokens generated before the process forked are shared with the
+        # other processes.
+        if self._pid != os.getpid():
+            self._tokens.clear()
+            self._pid = os.getpid()
+
+        try:
+            token = self._tokens.popleft()
+            hit = True
+        except IndexError:
+            token = self.generate()
+            hit = False
+
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if len(self._tokens) < self.low_water:
+            self._start_refill()
+
+        return token
+
+    def stats(self):
+        return {
+            'available': len(self._tokens),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+def get_token_pool():
     """
-    Create a unique token for a user.
+    Return the pool of tokens used by ``create_key``.
 
-    The token is created from the user id and a unique id generated
-    from UUIDv4. Then both are hashed using MD5 digest algorithm.
+    The pool is enabled by setting ``settings.LOGINURL_TOKEN_POOL_SIZE`` to
+    the number of tokens generated ahead of time in each process. It is
+    refilled when less than ``settings.LOGINURL_TOKEN_POOL_LOW_WATER`` tokens
+    are left, a quarter of the size by default. Returns ``None`` if the pool
+    is disabled.
     """
-    id = '{}-{}'.format(user.id, str(uuid.uuid4()))
-    hash = hashlib.md5(id.encode('ascii'))
-    hash.digest()
-    return hash.hexdigest()
+    global _token_pool
+
+    size = getattr(settings, 'LOGINURL_TOKEN_POOL_SIZE', 0)
+    if not size:
+        return None
+
+    low_water = getattr(settings, 'LOGINURL_TOKEN_POOL_LOW_WATER', size // 4)
+    if _token_pool is None or _token_pool.size != size or \
+       _token_pool.low_water != low_water:
+        _token_pool = TokenPool(size, low_water)
+
+    return _token_pool
 
 def create_key(user):
-    token = _create_token(user)
+    pool = get_token_pool()
+    if pool is not None:
+        token = pool.get()
+    else:
+        token = _create_token(user)
     b36_uid = int_to_base36(user.id)
     key = '{}-{}'.format(b36_uid, token)
 
     return key
 
-def create(user, usage_left=1, expires=None, next=None):
+def create_keys(users):
+    """
+    Create a key for each user of a list, like ``create_key``, generating all
+    the tokens at once.
+    """
+    tokens = random_tokens(len(users))
+    return ['{}-{}'.format(int_to_base36(user.id), token)
+            for user, token in zip(users, tokens)]
+
+def split_key(key):
+    """
+    Split a key created by ``create_key`` into the user id and the token as
+    raw bytes. Raises ``ValueError`` if the key is malformed.
+    """
+    match = KEY_RE.match(key)
+    if match is None or match.group(3) is not None:
+        raise ValueError('Malformed key')
+
+    uid, token, suffix = match.groups()
+    return base36_to_int(uid), binascii.unhexlify(token.encode('ascii'))
+
+def bytes_to_token(value):
+    """
+    Encode the raw bytes of a token as returned by ``split_key``.
+    """
+    return binascii.hexlify(bytes(value)).decode('ascii')
+
+def is_valid_format(key):
+    """
+    Check if the key looks like a key created by ``create_key``.
+
+    This allows rejecting malformed keys without looking them up.
+    """
+    return KEY_RE.match(key) is not None
+
+def create(user, usage_left=1, expires=None, next=None, reuse=False):
     """
     Create a secret login key for a user.
 
@@ -58,35 +246,305 @@ def create(user, usage_left=1, expires=None, next=None):
         A path or URL where the user using this key should be redirected to.
         If this parameter is None, then the default ``settings.LOGIN_URL`` will
         be used.
+
+    ``reuse``
+        If ``True``, a valid key of the user with the same ``usage_left`` and
+        ``next``, that has not been used yet and expires at most
+        ``settings.LOGINURL_REUSE_MARGIN`` seconds (one day by default) before
+        ``expires`` and not after it, is returned instead of creating a new
+        key when there is one. This is only supported by the model storages.
+
+    If ``settings.LOGINURL_MAX_ACTIVE_KEYS_PER_USER`` is set, the oldest valid
+    keys of the user are revoked so that the user has no more valid keys than
+    that.
+    """
+    from loginurl import metrics, audit
+    from loginurl.storage import get_storage
+
+    storage = get_storage()
+    with metrics.measure('create'):
+        if reuse:
+            data, created = storage.get_or_create(user, usage_left, expires,
+                                                  next)
+            if not created:
+                return data
+        else:
+            data = storage.create(user, usage_left, expires, next)
+
+        limit = getattr(settings, 'LOGINURL_MAX_ACTIVE_KEYS_PER_USER', None)
+        if limit:
+            storage.evict(user, limit)
+    audit.record(audit.ISSUED, data.key, user)
+    maybe_cleanup()
+
+    return data
+
+def _iter_queryset(queryset, batch_size):
+    """
+    Yield the objects of a queryset, read in batches ordered by primary key.
+    ``iterator`` still fetches all the rows at once with most databases.
     """
+    if not queryset.query.can_filter():
+        # A sliced queryset cannot be filtered further, its size is bounded
+        # by the slice anyway.
+        for obj in queryset.iterator():
+            yield obj
+        return
+
+    queryset = queryset.order_by('pk')
+    last = None
+    while True:
+        batch = queryset
+        if last is not None:
+            batch = batch.filter(pk__gt=last)
+        batch = list(batch[:batch_size])
+        if not batch:
+            break
+        last = batch[-1].pk
+
+        for obj in batch:
+            yield obj
+
+        if len(batch) < batch_size:
+            break
+
+def create_many(users, usage_left=1, expires=None, next=None,
+                batch_size=None):
+    """
+    Create secret login keys for many users at once.
+
+    This is the bulk counterpart of ``create``, meant for issuing keys for a
+    large number of users, e.g. for a mass email campaign. The keys are
+    inserted using ``bulk_create`` in chunks of ``batch_size`` rows, which
+    defaults to ``settings.LOGINURL_BATCH_SIZE`` or 1000.
+
+    ``users`` can be a queryset or any iterable of users. A queryset is read
+    in batches of ``batch_size`` users ordered by primary key, so that the
+    users are never loaded into memory all at once.
+
+    This is a generator: the keys are yielded as soon as the chunk containing
+    them has been inserted, so they have to be consumed for the keys to be
+    created. The yielded ``Key`` instances do not have their primary key set.
+
+    ``settings.LOGINURL_MAX_ACTIVE_KEYS_PER_USER`` is not applied to the keys
+    created by this function.
+
+    The other arguments are the same as ``create``.
+    """
+    from loginurl import bloom, audit
+    from loginurl.storage import get_storage
+
+    if batch_size is None:
+        batch_size = getattr(settings, 'LOGINURL_BATCH_SIZE', 1000)
+
+    if isinstance(users, QuerySet):
+        users = _iter_queryset(users, batch_size)
+    users = iter(users)
+
+    storage = get_storage()
+    while True:
+        chunk = list(islice(users, batch_size))
+        if not chunk:
+            break
+
+        created = storage.create_many(chunk, usage_left, expires, next)
+        # bulk_create does not send post_save.
+        bloom.add(data.key for data in created)
+        for data in created:
+            audit.record(audit.ISSUED, data.key, data.user)
+            yield data
+
+def active_keys(user):
+    """
+    Return the valid keys of a user, newest first.
+    """
+    from loginurl.storage import get_storage
+
+    return get_storage().active_keys(user)
+
+def revoke(user):
+    """
+    Make all the keys of a user invalid, e.g. when the user changes password.
+
+    The keys are revoked with a single ``UPDATE`` statement and are removed by
+    the next clean up. Returns the number of keys revoked, or ``None`` if the
+    storage does not know it, e.g. ``CacheStorage``.
+    """
+    from loginurl.storage import get_storage
+
+    return get_storage().revoke(user)
+
+def _to_timestamp(value):
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.get_default_timezone())
+    return calendar.timegm(value.utctimetuple())
+
+def _from_timestamp(value):
+    value = datetime.fromtimestamp(value, timezone.utc)
+    if not settings.USE_TZ:
+        value = timezone.make_naive(value, timezone.get_default_timezone())
+    return value
+
+def create_signed(user, usage_left=1, expires=None, next=None):
+    """
+    Create a signed login key for a user.
+
+    Unlike ``create``, nothing is stored in the database. The user id, the
+    usage limit, the expiry time and the ``next`` URL are encoded in the key
+    itself and signed using ``settings.SECRET_KEY``, so the key can be
+    validated without any database lookup.
+
+    Keys that can be used a limited number of times carry a random nonce. The
+    number of times a nonce has been used is kept in the cache selected by
+    ``settings.LOGINURL_SIGNED_CACHE`` (``default`` by default) until the key
+    expires, so such keys always expire. If ``expires`` is ``None``, they
+    expire after ``settings.LOGINURL_SIGNED_MAX_AGE`` seconds (30 days by
+    default). Keys without ``usage_left`` need no storage at all.
+
+    The arguments are the same as ``create``, but a string is returned instead
+    of a ``Key`` instance. Expiry times are stored with a one second
+    precision.
+    """
+    nonce = None
+    if usage_left is not None:
+        nonce = uuid.uuid4().hex
+        if expires is None:
+            max_age = getattr(settings, 'LOGINURL_SIGNED_MAX_AGE',
+                              30 * 24 * 60 * 60)
+            expires = timezone.now() + timedelta(seconds=max_age)
+
+    if expires is not None:
+        expires = _to_timestamp(expires)
+
+    payload = [user.id, usage_left, expires, next, nonce]
+    return signing.dumps(payload, salt=SIGNED_SALT, compress=True)
+
+def is_signed(key):
+    """
+    Check if the key has been created using ``create_signed``.
+    """
+    return ':' in key
+
+def consume_signed(key):
+    """
+    Validate a signed key and spend one of its usages.
+
+    Returns an unsaved ``Key`` instance holding the data encoded in the key,
+    or ``None`` if the signature is invalid, the key has expired or it has
+    been used up.
+    """
+    from django.contrib.auth.models import User
+
+    from loginurl import metrics
     from loginurl.models import Key
 
-    key = create_key(user)
+    try:
+        uid, usage_left, expires, next, nonce = signing.loads(key,
+                                                              salt=SIGNED_SALT)
+    except (signing.BadSignature, ValueError, TypeError):
+        metrics.report(key, metrics.INVALID)
+        return None
 
-    data = Key()
-    data.user = user
-    data.key = key
-    data.usage_left = usage_left
-    data.expires = expires
-    data.next = next
-    data.save()
+    if expires is not None:
+        expires = _from_timestamp(expires)
+
+    data = Key(user_id=uid, key=key, usage_left=usage_left, expires=expires,
+               next=next)
+    reason = data.invalid_reason()
+    if reason is not None:
+        metrics.report(key, reason)
+        return None
+
+    # The user may have been deleted since the key was signed.
+    try:
+        data.user
+    except User.DoesNotExist:
+        metrics.report(key, metrics.INVALID)
+        return None
+
+    if usage_left is not None:
+        timeout = int((expires - timezone.now()).total_seconds()) + 1
+        cache = get_cache(getattr(settings, 'LOGINURL_SIGNED_CACHE',
+                                  'default'))
+        name = 'loginurl:spent:{}'.format(nonce)
+        cache.add(name, 0, timeout)
+        try:
+            used = cache.incr(name)
+        except ValueError:
+            used = None
+
+        if used is None or used > usage_left:
+            metrics.report(key, metrics.EXHAUSTED)
+            return None
+        data.usage_left = usage_left - used
 
     return data
 
-def cleanup():
+def cleanup(batch_size=None, sleep=None):
     """
     Remove expired keys.
 
-    Keys that are no longer valid will be moved by calling this method.
+    Keys that are no longer valid will be moved by calling this method. They
+    are deleted in batches of ``batch_size`` keys, sleeping ``sleep`` seconds
+    between batches. The defaults are taken from
+    ``settings.LOGINURL_CLEANUP_BATCH_SIZE`` (1000) and
+    ``settings.LOGINURL_CLEANUP_SLEEP`` (0).
 
     A scheduled calls should be made to this method to make the database clean.
     This can be done in at least two ways: opening the ``cleanup`` view or
     running ``loginurl_cleanup`` command from the Django's management script.
+
+    Returns the number of keys removed.
     """
-    from loginurl.models import Key
+    from loginurl import metrics, audit
+    from loginurl.storage import get_storage
+
+    with metrics.measure('cleanup'):
+        count = get_storage().cleanup(batch_size, sleep)
+    audit.record(audit.CLEANUP, detail='{} keys removed'.format(count))
+    return count
+
+def _cleanup_batch(batch_size, close=False):
+    from loginurl import audit
+    from loginurl.storage import get_storage
+
+    try:
+        for position, removed in get_storage().iter_cleanup(batch_size):
+            audit.record(audit.CLEANUP,
+                         detail='{} keys removed'.format(removed))
+            break
+    finally:
+        _cleanup_lock.release()
+        if close:
+            connection.close()
+
+def maybe_cleanup():
+    """
+    Remove a small batch of expired keys on a fraction of calls.
+
+    This is called by ``create`` and the ``login`` view to keep the number of
+    stored keys steady without a scheduled clean up. It does nothing unless
+    ``settings.LOGINURL_CLEANUP_PROBABILITY`` is set to the fraction of calls
+    that should remove up to ``settings.LOGINURL_CLEANUP_AMORTIZED_BATCH_SIZE``
+    (100 by default) keys. If ``settings.LOGINURL_CLEANUP_THREAD`` is ``True``,
+    the keys are removed by a background thread instead of the caller.
+
+    A process never runs more than one of these clean ups at the same time.
+    """
+    probability = getattr(settings, 'LOGINURL_CLEANUP_PROBABILITY', 0)
+    if not probability or random.random() >= probability:
+        return
 
-    data = Key.objects.filter(Q(usage_left__lte=0) |
-                              Q(expires__lt=timezone.now()))
-    if data is not None:
-        data.delete()
+    if not _cleanup_lock.acquire(False):
+        return
 
+    batch_size = getattr(settings, 'LOGINURL_CLEANUP_AMORTIZED_BATCH_SIZE', 100)
+    if getattr(settings, 'LOGINURL_CLEANUP_THREAD', False):
+        # The thread gets its own database connection, which has to be closed
+        # when it is done.
+        thread = threading.Thread(target=_cleanup_batch,
+                                  args=(batch_size, True))
+        thread.daemon = True
+        thread.start()
+    else:
+        _cleanup_batch(batch_size)
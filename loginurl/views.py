@@ -1,16 +1,21 @@
+import time
+
 from django.http import HttpResponse, HttpResponseRedirect, HttpResponseGone
 from django.contrib import auth
 from django.conf import settings
 
-from loginurl import utils
-from loginurl.models import Key
+from loginurl import utils, throttling, metrics, audit
 
 def cleanup(request):
     """
     Remove expired keys.
     """
-    utils.cleanup()
-    return HttpResponse('ok', content_type='text/plain')
+    start = time.time()
+    count = utils.cleanup()
+    duration = time.time() - start
+
+    content = 'ok\n{} keys removed in {:.3f} seconds\n'.format(count, duration)
+    return HttpResponse(content, content_type='text/plain')
 
 def login(request, key):
     """
@@ -19,9 +24,9 @@ def login(request, key):
     When a visitor opens this view with a valid key, the visitor will be logged
     in using the user associated with the key.
 
-    When the log in is successful, the usage counter in the key is updated. If
-    the key is really a one time key, the next usage of the key will be
-    considered invalid.
+    The key is validated and its usage counter is updated by the authentication
+    backend in one step. If the key is really a one time key, the next usage of
+    the key will be considered invalid.
 
     A successful request will redirect the visitor to the URL associated with
     the key. If the URL is ``None``, a ``next`` parameter in the query string
@@ -31,28 +36,45 @@ def login(request, key):
     Visitor with an invalid key will be redirected to the default log in page
     specified in ``settings.LOGIN_REDIRECT_URL``. Any value in the ``next``
     parameter in the query string will be also forwarded.
+
+    If ``settings.LOGINURL_RATE_LIMIT`` is set, visitors with too many failed
+    attempts get a ``429 Too Many Requests`` response instead.
     """
+    with metrics.measure('login'):
+        return _login(request, key)
+
+def _login(request, key):
+    if throttling.is_throttled(request, key):
+        audit.record(audit.FAILURE, key, request=request, detail='throttled')
+        return HttpResponse('Too many attempts', status=429,
+                            content_type='text/plain')
+
     next = request.GET.get('next', None)
     if next is None:
         next = settings.LOGIN_REDIRECT_URL
 
-    # Validate the key through the standard Django's authentication mechanism.
-    # It also means that the authentication backend of this django-loginurl
-    # application has to be added to the authentication backends configuration.
-    user = auth.authenticate(key=key)
+    # Validate and consume the key through the standard Django's authentication
+    # mechanism. It also means that the authentication backend of this
+    # django-loginurl application has to be added to the authentication backends
+    # configuration.
+    with metrics.measure('login.authenticate'):
+        user = auth.authenticate(key=key)
     if user is None:
+        throttling.add_failure(request, key)
+        audit.record(audit.FAILURE, key, request=request)
+
         url = settings.LOGIN_URL
         if next is not None:
             url = '{}?next={}'.format(url, next)
         return HttpResponseRedirect(url)
 
     # The key is valid, then now log the user in.
-    auth.login(request, user)
-
-    # Update key usage.
-    data = Key.objects.get(key=key)
-    data.update_usage()
+    with metrics.measure('login.session'):
+        auth.login(request, user)
+    audit.record(audit.SUCCESS, key, user, request)
+    utils.maybe_cleanup()
 
+    data = user.loginurl_key
     if data.next is not None:
         next = data.next
 
@@ -11,6 +11,7 @@ setup(name='django-loginurl',
       url='http://github.com/fajran/django-loginurl/',
       license='BSD',
       download_url='http://github.com/fajran/django-loginurl/tarball/v0.2',
+      requires=['Django (>=1.6)'],
       packages=['loginurl', 'loginurl.management', 'loginurl.management.commands'],
       package_dir={'loginurl': 'loginurl'},
       zip_safe=False,